@@ -0,0 +1,927 @@
+#!/usr/bin/env python
+
+#Copyright (c) 2009 Steven Nichols <Steven@Steven-Nichols.com>
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+"""
+Benchmarks for Weather Wallpaper.
+
+Usage:
+    benchmark.py overlay pack.zip     # Per-render cost of the overlay text
+    benchmark.py scale pack.zip       # Decoding wallpapers at screen size
+    benchmark.py decode directory     # Draft mode JPEG decoding by scale
+    benchmark.py redraw pack.zip      # Redrawing only the lines that changed
+    benchmark.py borders pack.zip     # Drawing text borders 1 to 8 wide
+    benchmark.py encode pack.zip      # Output formats and their options
+    benchmark.py zipread              # Reading zip members in small pieces
+    benchmark.py decrypt              # Decrypting password protected members
+    benchmark.py extract              # Extraction throughput by worker count
+    benchmark.py compress             # Archive creation throughput
+    benchmark.py feeds                # Parsing weather provider feeds
+    benchmark.py pool                 # Feed requests with keep-alive
+    benchmark.py server pack.zip      # Render server latency under load
+"""
+
+import os
+import sys
+import time
+import timeit
+import shutil
+import tempfile
+import random
+import cStringIO
+import resource
+import threading
+import httplib
+import BaseHTTPServer
+import SocketServer
+from xml.etree.ElementTree import parse
+from xml.dom import minidom
+
+import weatherpaper
+import pywapi
+import zipfile
+import renderserver
+
+# Weather status used for rendering
+SAMPLE_STATUS = {
+    'title': 'Sample Wallpaper',
+    'author': 'Someone',
+    'filename': '',
+    'code': '32',
+    'temp': '72',
+    'feels_like': '72',
+    'condition': 'Fair',
+    'date': 'Mon, 05 Oct 2009 4:53 pm EDT',
+    'humidity': '65',
+    'wind_chill': '72',
+    'forecast': 'Sunny',
+    'temp_unit': 'F',
+}
+
+# Weather feeds as recorded from each provider, used by the feeds benchmark
+GOOGLE_FEED = """<?xml version="1.0"?>
+<xml_api_reply version="1"><weather module_id="0" tab_id="0" mobile_row="0" mobile_zipped="1" row="0" section="0" >
+<forecast_information><city data="New York, NY"/><postal_code data="10001"/><latitude_e6 data=""/><longitude_e6 data=""/><forecast_date data="2009-10-05"/><current_date_time data="2009-10-05 20:51:00 +0000"/><unit_system data="US"/></forecast_information>
+<current_conditions><condition data="Clear"/><temp_f data="64"/><temp_c data="18"/><humidity data="Humidity: 42%"/><icon data="/ig/images/weather/sunny.gif"/><wind_condition data="Wind: N at 8 mph"/></current_conditions>
+<forecast_conditions><day_of_week data="Mon"/><low data="52"/><high data="66"/><icon data="/ig/images/weather/sunny.gif"/><condition data="Clear"/></forecast_conditions>
+<forecast_conditions><day_of_week data="Tue"/><low data="55"/><high data="70"/><icon data="/ig/images/weather/mostly_sunny.gif"/><condition data="Mostly Sunny"/></forecast_conditions>
+<forecast_conditions><day_of_week data="Wed"/><low data="57"/><high data="72"/><icon data="/ig/images/weather/chance_of_rain.gif"/><condition data="Chance of Rain"/></forecast_conditions>
+<forecast_conditions><day_of_week data="Thu"/><low data="50"/><high data="63"/><icon data="/ig/images/weather/rain.gif"/><condition data="Rain"/></forecast_conditions>
+</weather></xml_api_reply>"""
+
+YAHOO_FEED = """<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>
+<rss version="2.0" xmlns:yweather="http://xml.weather.yahoo.com/ns/rss/1.0" xmlns:geo="http://www.w3.org/2003/01/geo/wgs84_pos#">
+<channel>
+<title>Yahoo! Weather - New York, NY</title>
+<link>http://us.rd.yahoo.com/dailynews/rss/weather/New_York__NY/*http://weather.yahoo.com/forecast/USNY0996_f.html</link>
+<description>Yahoo! Weather for New York, NY</description>
+<language>en-us</language>
+<lastBuildDate>Mon, 05 Oct 2009 4:51 pm EDT</lastBuildDate>
+<ttl>60</ttl>
+<yweather:location city="New York" region="NY"   country="US"/>
+<yweather:units temperature="F" distance="mi" pressure="in" speed="mph"/>
+<yweather:wind chill="64"   direction="0"   speed="8" />
+<yweather:atmosphere humidity="42"  visibility="10"  pressure="30.12"  rising="1" />
+<yweather:astronomy sunrise="7:00 am"   sunset="6:31 pm"/>
+<image>
+<title>Yahoo! Weather</title>
+<width>142</width>
+<height>18</height>
+<link>http://weather.yahoo.com</link>
+<url>http://l.yimg.com/a/i/us/nws/th/main_142b.gif</url>
+</image>
+<item>
+<title>Conditions for New York, NY at 4:51 pm EDT</title>
+<geo:lat>40.67</geo:lat>
+<geo:long>-73.94</geo:long>
+<link>http://us.rd.yahoo.com/dailynews/rss/weather/New_York__NY/*http://weather.yahoo.com/forecast/USNY0996_f.html</link>
+<pubDate>Mon, 05 Oct 2009 4:51 pm EDT</pubDate>
+<yweather:condition  text="Fair"  code="34"  temp="64"  date="Mon, 05 Oct 2009 4:51 pm EDT" />
+<description><![CDATA[
+<img src="http://l.yimg.com/a/i/us/we/52/34.gif"/><br />
+<b>Current Conditions:</b><br />
+Fair, 64 F<BR />
+<BR /><b>Forecast:</b><BR />
+Mon - Clear. High: 66 Low: 52<br />
+Tue - Mostly Sunny. High: 70 Low: 55<br />
+<br />
+<a href="http://us.rd.yahoo.com/dailynews/rss/weather/New_York__NY/*http://weather.yahoo.com/forecast/USNY0996_f.html">Full Forecast at Yahoo! Weather</a><BR/><BR/>
+(provided by <a href="http://www.weather.com" >The Weather Channel</a>)<br/>
+]]></description>
+<yweather:forecast day="Mon" date="5 Oct 2009" low="52" high="66" text="Clear" code="31" />
+<yweather:forecast day="Tue" date="6 Oct 2009" low="55" high="70" text="Mostly Sunny" code="34" />
+<guid isPermaLink="false">USNY0996_2009_10_05_16_51_EDT</guid>
+</item>
+</channel>
+</rss>"""
+
+NOAA_FEED = """<?xml version="1.0" encoding="ISO-8859-1"?>
+<current_observation version="1.0"
+	 xmlns:xsd="http://www.w3.org/2001/XMLSchema"
+	 xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+	 xsi:noNamespaceSchemaLocation="http://www.weather.gov/view/current_observation.xsd">
+	<credit>NOAA's National Weather Service</credit>
+	<credit_URL>http://weather.gov/</credit_URL>
+	<image>
+		<url>http://weather.gov/images/xml_logo.gif</url>
+		<title>NOAA's National Weather Service</title>
+		<link>http://weather.gov</link>
+	</image>
+	<suggested_pickup>15 minutes after the hour</suggested_pickup>
+	<suggested_pickup_period>60</suggested_pickup_period>
+	<location>New York City, Central Park, NY</location>
+	<station_id>KNYC</station_id>
+	<latitude>40.78</latitude>
+	<longitude>-73.97</longitude>
+	<observation_time>Last Updated on Oct 5 2009, 3:51 pm EDT</observation_time>
+	<observation_time_rfc822>Mon, 05 Oct 2009 15:51:00 -0400 EDT</observation_time_rfc822>
+	<weather>Fair</weather>
+	<temperature_string>64 F (18 C)</temperature_string>
+	<temp_f>64</temp_f>
+	<temp_c>18</temp_c>
+	<relative_humidity>42</relative_humidity>
+	<wind_string>North at 8 MPH</wind_string>
+	<wind_dir>North</wind_dir>
+	<wind_degrees>0</wind_degrees>
+	<wind_mph>8.05</wind_mph>
+	<wind_gust_mph>NA</wind_gust_mph>
+	<pressure_string>1019.9 mb</pressure_string>
+	<pressure_mb>1019.9</pressure_mb>
+	<pressure_in>30.12</pressure_in>
+	<dewpoint_string>41 F (5 C)</dewpoint_string>
+	<dewpoint_f>41</dewpoint_f>
+	<dewpoint_c>5</dewpoint_c>
+	<heat_index_string>NA</heat_index_string>
+	<heat_index_f>NA</heat_index_f>
+	<heat_index_c>NA</heat_index_c>
+	<windchill_string>NA</windchill_string>
+	<windchill_f>NA</windchill_f>
+	<windchill_c>NA</windchill_c>
+	<icon_url_base>http://weather.gov/weather/images/fcicons/</icon_url_base>
+	<icon_url_name>skc.jpg</icon_url_name>
+	<two_day_history_url>http://www.weather.gov/data/obhistory/KNYC.html</two_day_history_url>
+	<ob_url>http://www.nws.noaa.gov/data/METAR/KNYC.1.txt</ob_url>
+	<disclaimer_url>http://weather.gov/disclaimer.html</disclaimer_url>
+	<copyright_url>http://weather.gov/disclaimer.html</copyright_url>
+	<privacy_policy_url>http://weather.gov/notice.html</privacy_policy_url>
+</current_observation>"""
+
+GISMETEO_FORECAST = """<FORECAST day="05" month="10" year="2009" hour="%s" tod="%s" predict="0" weekday="2">
+<PHENOMENA cloudiness="0" precipitation="10" rpower="0" spower="0"/>
+<PRESSURE max="761" min="759"/>
+<TEMPERATURE max="18" min="16"/>
+<WIND min="3" max="5" direction="0"/>
+<RELWET max="45" min="40"/>
+<HEAT min="16" max="18"/>
+</FORECAST>
+"""
+
+GISMETEO_FEED = """<?xml version="1.0" encoding="UTF-8"?>
+<MMWEATHER>
+<REPORT type="frc3">
+<TOWN index="72503" sname="%CD%FC%FE-%C9%EE%F0%EA" latitude="41" longitude="-74">
+""" + "".join([GISMETEO_FORECAST % (hour, tod)
+    for (hour, tod) in (("03", "0"), ("09", "1"), ("15", "2"), ("21", "3"))]) + \
+"""</TOWN>
+</REPORT>
+</MMWEATHER>"""
+
+# Fields get_weather_from_noaa() looks up
+NOAA_FIELDS = ('suggested_pickup', 'suggested_pickup_period', 'location',
+    'station_id', 'latitude', 'longitude', 'observation_time',
+    'observation_time_rfc822', 'weather', 'temperature_string', 'temp_f',
+    'temp_c', 'relative_humidity', 'wind_string', 'wind_dir', 'wind_degrees',
+    'wind_mph', 'wind_gust_mph', 'pressure_string', 'pressure_mb',
+    'pressure_in', 'dewpoint_string', 'dewpoint_f', 'dewpoint_c',
+    'heat_index_string', 'heat_index_f', 'heat_index_c', 'windchill_string',
+    'windchill_f', 'windchill_c', 'icon_url_base', 'icon_url_name',
+    'two_day_history_url', 'ob_url')
+
+def bestTime(func, number=100, repeat=3):
+    """Return the best time (in seconds) of a single call to func"""
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat, number)) / number
+
+def report(name, seconds):
+    print "%-40s %10.3f ms" % (name, seconds * 1000)
+
+def useSettings(pack_file):
+    """Use the default settings with the given wallpaper pack"""
+    settings = weatherpaper.getDefaultSettings()
+    settings['wallpaper_pack'] = os.path.abspath(pack_file)
+    weatherpaper.AppSettings = settings
+
+    status = dict(SAMPLE_STATUS)
+    status['filename'] = weatherpaper.getWallpaper(status['code']).file
+    return status
+
+def legacyOverlayTexts(pack, WStatus):
+    """The text preparation done on every render before overlay.xml was
+    compiled into a render plan.
+
+    """
+    AppSettings = weatherpaper.AppSettings
+
+    xml_file = pack.open(weatherpaper._OVERLAY_FILE)
+    root = parse(xml_file).getroot()
+    xml_file.close()
+
+    texts = []
+    for font in root:
+        try:
+            size = int(font.attrib['size'])
+        except KeyError:
+            size = weatherpaper._DEFAULT_FONT_SIZE
+        try:
+            fill_color = font.attrib['fill']
+        except KeyError:
+            fill_color = weatherpaper._DEFAULT_FONT_COLOR
+        try:
+            alignment = font.attrib['align']
+        except KeyError:
+            alignment = None
+        try:
+            border = int(font.attrib['border'])
+            bordercolor = font.attrib['bordercolor']
+        except KeyError:
+            border = None
+            bordercolor = None
+
+        for line in font:
+            text = '' if line.text == None else line.text
+            if WStatus['code'] != weatherpaper._WEATHER_ERROR_CODE and line.tag != 'errorline':
+                text = text.replace('%title%', WStatus['title'])
+                text = text.replace('%author%', WStatus['author'])
+                text = text.replace('%temp%', WStatus['temp'])
+                text = text.replace('%degree%', u'\u00B0')
+                text = text.replace('%unit%', 'C' if AppSettings['metric_units'] else 'F' )
+                text = text.replace('%condition%', WStatus['condition'])
+                text = text.replace('%humidity%', WStatus['humidity'])
+                text = text.replace('%date%', WStatus['date'])
+                text = text.replace('%forecast%', WStatus['forecast'])
+                text = text.replace('%feelslike%', str(WStatus['feels_like']))
+            elif WStatus['code'] == weatherpaper._WEATHER_ERROR_CODE and line.tag == 'errorline':
+                text = text.replace('%errormsg%', WStatus['errormsg'])
+            else:
+                continue
+
+            try:
+                x = int(line.attrib['x'])
+            except KeyError:
+                pass
+            try:
+                y = int(line.attrib['y'])
+            except KeyError:
+                pass
+            texts.append(text)
+
+    return texts
+
+def benchOverlay(pack_file):
+    """Compare the per-render cost of preparing the overlay text from
+    overlay.xml against using the compiled render plan.
+
+    """
+    status = useSettings(pack_file)
+    pack = weatherpaper.getPack()
+    plan = pack.getOverlay()
+
+    report("overlay.xml parsed every render",
+        bestTime(lambda: legacyOverlayTexts(pack, status)))
+    report("compiled render plan",
+        bestTime(lambda: weatherpaper.getOverlayTexts(plan, status)))
+
+def benchScale(pack_file):
+    """Compare decoding, drawing on and saving a wallpaper at full size
+    against doing the same with the image scaled to the screen.
+
+    """
+    status = useSettings(pack_file)
+    pack = weatherpaper.getPack()
+    plan = pack.getOverlay()
+    texts = weatherpaper.getOverlayTexts(plan, status)
+    size = (weatherpaper.AppSettings['screen_width'],
+        weatherpaper.AppSettings['screen_height'])
+
+    def render(size):
+        image = weatherpaper.loadImage(pack, status['filename'], size)
+        weatherpaper.renderOverlay(image, plan, texts)
+        encoder = weatherpaper.getOutputEncoder()
+        image.save(cStringIO.StringIO(), encoder.format, **encoder.options)
+
+    full = weatherpaper.loadImage(pack, status['filename'])
+    report("full size, %dx%d" % full.size, bestTime(lambda: render(None), 10))
+    report("scaled, %dx%d" % size, bestTime(lambda: render(size), 10))
+
+def benchRedraw(pack_file):
+    """Compare drawing the whole overlay on a fresh copy of the wallpaper
+    with redrawing only the lines that changed, as the temperature ticks up
+    and down by a degree.
+
+    """
+    status = useSettings(pack_file)
+    pack = weatherpaper.getPack()
+    plan = pack.getOverlay()
+    size = (weatherpaper.AppSettings['screen_width'],
+        weatherpaper.AppSettings['screen_height'])
+    base = weatherpaper.loadImage(pack, status['filename'], size)
+
+    temps = []
+    for temp in range(60, 80):
+        tick = dict(status, temp=str(temp))
+        temps.append(weatherpaper.getOverlayTexts(plan, tick))
+    temps = iter(temps * 1000)
+
+    def full():
+        weatherpaper.renderOverlay(base.copy(), plan, temps.next())
+
+    frame = weatherpaper.OverlayFrame()
+    def partial():
+        frame.render(None, plan, temps.next(), base.copy)
+
+    report("whole overlay", bestTime(full, 20))
+    report("changed lines only", bestTime(partial, 20))
+
+def legacyDrawLine(draw, line, text, position):
+    """Draw a line of the overlay with its border drawn the way it was
+    before, by drawing the text four times for each pixel of border.
+
+    """
+    (left, y) = position[:2]
+    font_obj = line.font
+    border = line.border
+    bordercolor = line.bordercolor
+    for i in range(0, border):
+        if i == 0:
+            draw.text((left-1, y), text, font=font_obj, fill=bordercolor)
+            draw.text((left+1, y), text, font=font_obj, fill=bordercolor)
+            draw.text((left, y-1), text, font=font_obj, fill=bordercolor)
+            draw.text((left, y+1), text, font=font_obj, fill=bordercolor)
+        else:
+            draw.text((left-i, y-i), text, font=font_obj, fill=bordercolor)
+            draw.text((left+i, y-i), text, font=font_obj, fill=bordercolor)
+            draw.text((left-i, y+i), text, font=font_obj, fill=bordercolor)
+            draw.text((left+i, y+i), text, font=font_obj, fill=bordercolor)
+    draw.text((left, y), text, font=font_obj, fill=line.fill)
+
+def benchBorders(pack_file):
+    """Compare drawing the first line of the overlay with borders 1 to 8
+    pixels wide by drawing the text for each pixel of border against
+    drawing it once and widening it with a filter.
+
+    """
+    status = useSettings(pack_file)
+    pack = weatherpaper.getPack()
+    plan = pack.getOverlay()
+    texts = weatherpaper.getOverlayTexts(plan, status)
+    size = (weatherpaper.AppSettings['screen_width'],
+        weatherpaper.AppSettings['screen_height'])
+    base = weatherpaper.loadImage(pack, status['filename'], size)
+    draw = weatherpaper.ImageDraw.Draw(base)
+    position = weatherpaper.layoutOverlay(draw, size, plan, texts)[0]
+
+    for border in range(1, 9):
+        line = plan[0]._replace(border=border,
+            bordercolor=plan[0].bordercolor or "black")
+        for (name, func) in (("draw.text per pixel", legacyDrawLine),
+                ("mask and max filter", weatherpaper.drawLine)):
+            report("border %d, %s" % (border, name), bestTime(
+                lambda: func(draw, line, texts[0], position), 20))
+
+def benchEncode(pack_file):
+    """Report the time taken to save a rendered wallpaper and the size of
+    the file for each output format and the options that matter to it.
+
+    """
+    status = useSettings(pack_file)
+    pack = weatherpaper.getPack()
+    plan = pack.getOverlay()
+    size = (weatherpaper.AppSettings['screen_width'],
+        weatherpaper.AppSettings['screen_height'])
+    image = weatherpaper.loadImage(pack, status['filename'], size)
+    weatherpaper.renderOverlay(image, plan,
+        weatherpaper.getOverlayTexts(plan, status))
+
+    defaults = weatherpaper.getDefaultSettings()
+    for (name, changes) in (
+            ("jpeg, quality 100, 4:4:4 (old output)", {'output_quality': 100,
+                'output_subsampling': '4:4:4'}),
+            ("jpeg, quality 95", {'output_quality': 95}),
+            ("jpeg, quality 85 (default)", {}),
+            ("jpeg, quality 75", {'output_quality': 75}),
+            ("jpeg, quality 85, 4:4:4", {'output_subsampling': '4:4:4'}),
+            ("jpeg, quality 85, optimize", {'output_optimize': True}),
+            ("jpeg, quality 85, progressive", {'output_progressive': True}),
+            ("png, compress level 1", {'output_format': 'png'}),
+            ("png, compress level 6", {'output_format': 'png',
+                'output_compress_level': 6}),
+            ("png, compress level 9", {'output_format': 'png',
+                'output_compress_level': 9}),
+            ("bmp", {'output_format': 'bmp'}),
+            ("ppm", {'output_format': 'ppm'})):
+        encoder = weatherpaper.getOutputEncoder(dict(defaults, **changes))
+        output = cStringIO.StringIO()
+        image.save(output, encoder.format, **encoder.options)
+        print "%-40s %10d KB" % (name, len(output.getvalue()) / 1024)
+        report("  encode", bestTime(lambda: image.save(cStringIO.StringIO(),
+            encoder.format, **encoder.options), 5))
+
+def benchDecode(directory):
+    """Compare decode time and peak memory of every JPEG wallpaper in a
+    directory decoded at full size and at 1/2, 1/4 and 1/8 of it, which
+    draft mode decodes directly.
+
+    """
+    cases = []
+    for name in sorted(os.listdir(directory)):
+        if os.path.splitext(name)[1].lower() not in ('.jpg', '.jpeg'):
+            continue
+        data = open(os.path.join(directory, name), 'rb').read()
+        # Only the header is read, so nothing is decoded in this process yet
+        (width, height) = weatherpaper.Image.open(cStringIO.StringIO(data)).size
+        for scale in (None, 2, 4, 8):
+            if scale is None:
+                size = None
+                label = "full size"
+            else:
+                size = (width / scale, height / scale)
+                label = "1/%d, %dx%d" % ((scale,) + size)
+            cases.append(("%s, %dx%d" % (name, width, height), label, data,
+                size))
+
+    # Measure memory before anything is decoded here, as a forked child
+    # reuses whatever memory its parent already has resident
+    peaks = [peakMemory(lambda: weatherpaper.decodeImage(data, size))
+        for (image, label, data, size) in cases]
+
+    previous = None
+    for ((image, label, data, size), kilobytes) in zip(cases, peaks):
+        if image != previous:
+            print image
+            previous = image
+        report("decode " + label, bestTime(
+            lambda: weatherpaper.decodeImage(data, size), 5))
+        if kilobytes is not None:
+            print "%-40s %10d KB" % ("peak memory growth, " + label,
+                kilobytes)
+
+def benchZipRead():
+    """Time reading members of increasing size line by line and in small
+    pieces. The time per megabyte should stay the same as members grow.
+
+    """
+    line = "<image codes=\"32, 34\"><file>sunny.jpg</file></image>\n"
+
+    for megabytes in (1, 2, 4, 8):
+        data = line * (megabytes * 1024 * 1024 / len(line))
+        archive = cStringIO.StringIO()
+        zf = zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED)
+        zf.writestr("member.xml", data)
+        zf.close()
+        zf = zipfile.ZipFile(archive, "r")
+
+        def readLines():
+            for l in zf.open("member.xml"):
+                pass
+
+        def readPieces():
+            member = zf.open("member.xml")
+            while member.read(100):
+                pass
+
+        for name, func in (("readline", readLines), ("read(100)", readPieces)):
+            seconds = bestTime(func, number=1)
+            report("%s, %d MB member, per MB" % (name, megabytes),
+                seconds / megabytes)
+
+def benchDecrypt():
+    """Compare decrypting a member one character at a time against
+    decrypting it in bulk.
+
+    """
+    data = os.urandom(1024 * 1024)
+
+    report("per character, 1 MB", bestTime(
+        lambda: ''.join(map(zipfile._ZipDecrypter("secret"), data)), 1))
+    report("bulk decrypt(), 1 MB", bestTime(
+        lambda: zipfile._ZipDecrypter("secret").decrypt(data), 1))
+
+def makeSampleFiles(directory, count, size):
+    """Create count files of size bytes of compressible data, returning
+    their paths.
+
+    """
+    random.seed(0)
+    words = ["sunny", "cloudy", "rain", "snow", "fog", "wind", "%temp%"]
+    paths = []
+    for i in range(count):
+        text = " ".join([random.choice(words) for j in range(size / 5)])
+        path = os.path.join(directory, "sample%03d.txt" % i)
+        f = open(path, "wb")
+        f.write(text[:size])
+        f.close()
+        paths.append(path)
+    return paths
+
+def benchExtract():
+    """Report extraction throughput of a deflated archive for increasing
+    numbers of worker threads.
+
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        archive = os.path.join(directory, "sample.zip")
+        zf = zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED)
+        total = 0
+        for path in makeSampleFiles(directory, 32, 4 * 1024 * 1024):
+            zf.write(path, os.path.basename(path))
+            total += os.path.getsize(path)
+        zf.close()
+
+        for workers in (1, 2, 4, 8):
+            target = os.path.join(directory, "out%d" % workers)
+            zf = zipfile.ZipFile(archive, "r")
+            seconds = bestTime(lambda: zf.extractall(target, workers=workers),
+                number=1)
+            zf.close()
+            print "%d workers: %8.1f MB/s" % (workers,
+                total / seconds / (1024 * 1024))
+    finally:
+        shutil.rmtree(directory, True)
+
+def benchCompress():
+    """Report archive creation throughput for increasing numbers of worker
+    threads, and the cost of deflating already compressed images.
+
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        paths = makeSampleFiles(directory, 32, 4 * 1024 * 1024)
+        total = sum([os.path.getsize(path) for path in paths])
+        archive = os.path.join(directory, "sample.zip")
+
+        for workers in (1, 2, 4, 8):
+            def create():
+                zf = zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED)
+                zf.writeall(paths, workers=workers)
+                zf.close()
+            seconds = bestTime(create, number=1)
+            print "%d workers: %8.1f MB/s" % (workers,
+                total / seconds / (1024 * 1024))
+
+        images = []
+        for i in range(8):
+            path = os.path.join(directory, "image%d.jpg" % i)
+            f = open(path, "wb")
+            f.write(os.urandom(2 * 1024 * 1024))
+            f.close()
+            images.append(path)
+
+        for name, store in (("images deflated", False), ("images stored", True)):
+            def create():
+                zf = zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED)
+                zf.writeall(images, storeCompressed=store)
+                zf.close()
+            seconds = bestTime(create, number=1)
+            report("%s, %d bytes" % (name, os.path.getsize(archive)), seconds)
+    finally:
+        shutil.rmtree(directory, True)
+
+def legacyGoogle(dom):
+    """The minidom lookups get_weather_from_google() used to do."""
+    weather_data = {}
+    weather_dom = dom.getElementsByTagName('weather')[0]
+    data_structure = {
+        'forecast_information': ('city', 'postal_code', 'latitude_e6', 'longitude_e6', 'forecast_date', 'current_date_time', 'unit_system'),
+        'current_conditions': ('condition','temp_f', 'temp_c', 'humidity', 'wind_condition', 'icon')
+    }
+    for (tag, list_of_tags2) in data_structure.iteritems():
+        tmp_conditions = {}
+        for tag2 in list_of_tags2:
+            tmp_conditions[tag2] = weather_dom.getElementsByTagName(tag)[0].getElementsByTagName(tag2)[0].getAttribute('data')
+        weather_data[tag] = tmp_conditions
+
+    forecasts = []
+    for forecast in dom.getElementsByTagName('forecast_conditions'):
+        tmp_forecast = {}
+        for tag in ('day_of_week', 'low', 'high', 'icon', 'condition'):
+            tmp_forecast[tag] = forecast.getElementsByTagName(tag)[0].getAttribute('data')
+        forecasts.append(tmp_forecast)
+    weather_data['forecasts'] = forecasts
+    return weather_data
+
+def legacyYahoo(dom):
+    """The minidom lookups get_weather_from_yahoo() used to do."""
+    weather_data = {}
+    weather_data['title'] = dom.getElementsByTagName('title')[0].firstChild.data
+    weather_data['link'] = dom.getElementsByTagName('link')[0].firstChild.data
+    ns_data_structure = {
+        'location': ('city', 'region', 'country'),
+        'units': ('temperature', 'distance', 'pressure', 'speed'),
+        'wind': ('chill', 'direction', 'speed'),
+        'atmosphere': ('humidity', 'visibility', 'pressure', 'rising'),
+        'astronomy': ('sunrise', 'sunset'),
+        'condition': ('text', 'code', 'temp', 'date')
+    }
+    for (tag, attrs) in ns_data_structure.iteritems():
+        weather_data[tag] = pywapi.xml_get_ns_yahoo_tag(dom, pywapi.YAHOO_WEATHER_NS, tag, attrs)
+
+    weather_data['geo'] = {}
+    weather_data['geo']['lat'] = dom.getElementsByTagName('geo:lat')[0].firstChild.data
+    weather_data['geo']['long'] = dom.getElementsByTagName('geo:long')[0].firstChild.data
+    weather_data['condition']['title'] = dom.getElementsByTagName('item')[0].getElementsByTagName('title')[0].firstChild.data
+    weather_data['html_description'] = dom.getElementsByTagName('item')[0].getElementsByTagName('description')[0].firstChild.data
+
+    forecasts = []
+    for forecast in dom.getElementsByTagNameNS(pywapi.YAHOO_WEATHER_NS, 'forecast'):
+        forecasts.append(pywapi.xml_get_attrs(forecast, ('date', 'low', 'high', 'text', 'code')))
+    weather_data['forecasts'] = forecasts
+    return weather_data
+
+def legacyNoaa(dom):
+    """The minidom lookups get_weather_from_noaa() used to do."""
+    weather_data = {}
+    current_observation = dom.getElementsByTagName('current_observation')[0]
+    for tag in NOAA_FIELDS:
+        weather_data[tag] = current_observation.getElementsByTagName(tag)[0].firstChild.data
+    return weather_data
+
+def legacyGismeteo(dom):
+    """The minidom lookups get_weather_from_gismeteo() used to do."""
+    forecast_data_structure = {
+        'PHENOMENA': ('cloudiness','precipitation', 'rpower', 'spower'),
+        'PRESSURE': ('max','min'),
+        'TEMPERATURE': ('max','min'),
+        'WIND': ('max','min', 'direction'),
+        'RELWET': ('max','min'),
+        'HEAT': ('max','min'),
+    }
+    weather_data = {}
+    weather_data['town'] = pywapi.xml_get_attrs(dom.getElementsByTagName('TOWN')[0],
+        ('index', 'sname', 'latitude','longitude'))
+    forecasts = []
+    for forecast in dom.getElementsByTagName('FORECAST'):
+        tmp_forecast = pywapi.xml_get_attrs(forecast,
+            ('day', 'month', 'year', 'hour', 'tod', 'predict', 'weekday'))
+        for (tag, attrs) in forecast_data_structure.iteritems():
+            tmp_forecast[tag.lower()] = pywapi.xml_get_attrs(forecast.getElementsByTagName(tag)[0], attrs)
+        forecasts.append(tmp_forecast)
+    weather_data['forecasts'] = forecasts
+    return weather_data
+
+def legacyParse(legacy, source):
+    """Parse source with minidom and extract the weather data from the
+    tree the way the fetchers used to.
+
+    """
+    dom = minidom.parse(source)
+    weather_data = legacy(dom)
+    dom.unlink()
+    return weather_data
+
+def peakMemory(func):
+    """Return how many kilobytes the peak resident size of a forked child
+    grows by while calling func, or None where fork() is unavailable.
+
+    """
+    if not hasattr(os, 'fork'):
+        return None
+
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        func()
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_fd, str(after - before))
+        os._exit(0)
+
+    os.close(write_fd)
+    result = os.read(read_fd, 64)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return int(result)
+
+def benchFeeds():
+    """Compare parse time and peak memory of the streaming feed parsers
+    against building a minidom tree, on recorded feeds from each provider.
+    Peak memory is measured on a GisMeteo feed with 20000 forecasts.
+
+    """
+    feeds = (
+        ("google", GOOGLE_FEED, legacyGoogle, pywapi.parse_google),
+        ("yahoo", YAHOO_FEED, legacyYahoo, pywapi.parse_yahoo),
+        ("noaa", NOAA_FEED, legacyNoaa, pywapi.parse_noaa),
+        ("gismeteo", GISMETEO_FEED, legacyGismeteo, pywapi.parse_gismeteo),
+    )
+    for (name, feed, legacy, parser) in feeds:
+        report("%s, minidom" % name, bestTime(
+            lambda: legacyParse(legacy, cStringIO.StringIO(feed))))
+        report("%s, streaming" % name, bestTime(
+            lambda: parser(cStringIO.StringIO(feed))))
+
+    forecast = GISMETEO_FORECAST % ("03", "0")
+    (head, tail) = GISMETEO_FEED.split("<FORECAST", 1)
+    tail = tail[tail.index("</TOWN>"):]
+    large = head + forecast * 20000 + tail
+    print "%-40s %10.1f MB" % ("large feed", len(large) / (1024.0 * 1024))
+
+    for (name, func) in (
+            ("minidom", lambda: legacyParse(legacyGismeteo,
+                cStringIO.StringIO(large))),
+            ("streaming", lambda: pywapi.parse_gismeteo(
+                cStringIO.StringIO(large)))):
+        kilobytes = peakMemory(func)
+        if kilobytes is not None:
+            print "%-40s %10d KB" % ("peak memory growth, " + name, kilobytes)
+
+class FeedRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the recorded Yahoo! feed for any path, keeping the
+    connection open between requests. The server's round_trip delay is
+    added once for each new connection, standing in for the TCP
+    handshake, and once for each request.
+
+    """
+    protocol_version = "HTTP/1.1"
+    # Send each response in one piece, as real servers do
+    wbufsize = -1
+
+    def setup(self):
+        time.sleep(self.server.round_trip)
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def do_GET(self):
+        time.sleep(self.server.round_trip)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(YAHOO_FEED)))
+        self.end_headers()
+        self.wfile.write(YAHOO_FEED)
+
+    def log_message(self, format, *args):
+        pass
+
+class FeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    round_trip = 0
+
+def benchPool():
+    """Compare Yahoo! feed requests per second against a local server
+    with and without reusing connections, for a few network round trip
+    times.
+
+    """
+    server = FeedServer(("127.0.0.1", 0), FeedRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    url = pywapi.YAHOO_WEATHER_URL
+    pywapi.YAHOO_WEATHER_URL = "http://127.0.0.1:%d/forecastrss?p=%%s&u=%%s" \
+        % server.server_address[1]
+    try:
+        for milliseconds in (0, 5, 20):
+            server.round_trip = milliseconds / 1000.0
+            for (name, pool) in (("new connections", None),
+                    ("connection pool", pywapi.ConnectionPool())):
+                pywapi.set_connection_pool(pool)
+                seconds = bestTime(
+                    lambda: pywapi.get_weather_from_yahoo("USNY0996"),
+                    2000 / (milliseconds + 10))
+                print "%-40s %10.1f requests/s" % ("%s, %d ms round trip"
+                    % (name, milliseconds), 1 / seconds)
+    finally:
+        pywapi.YAHOO_WEATHER_URL = url
+        pywapi.set_connection_pool(pywapi.ConnectionPool())
+        server.shutdown()
+
+def percentile(values, fraction):
+    """Return the value below which the given fraction of the sorted
+    values fall.
+
+    """
+    return values[int(round(fraction * (len(values) - 1)))]
+
+def benchServer(pack_file):
+    """Load test the render server: a number of clients each request
+    wallpapers for random locations, sizes and units over one connection,
+    and the latency of every request is recorded. Weather reports come from
+    a local server replaying the recorded Yahoo! feed.
+
+    """
+    feeds = FeedServer(("127.0.0.1", 0), FeedRequestHandler)
+    thread = threading.Thread(target=feeds.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = pywapi.YAHOO_WEATHER_URL
+    pywapi.YAHOO_WEATHER_URL = "http://127.0.0.1:%d/forecastrss?p=%%s&u=%%s" \
+        % feeds.server_address[1]
+
+    pack_file = os.path.abspath(pack_file)
+    server = renderserver.createServer(os.path.dirname(pack_file),
+        ("127.0.0.1", 0), renderserver.cpuCount(), 600)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    clients = 16
+    requests = 50
+    sizes = ((1024, 768), (1280, 800), (1920, 1200))
+    locations = ["USNY%04d" % i for i in range(50)]
+
+    def client(latencies):
+        connection = httplib.HTTPConnection("127.0.0.1", server.server_address[1])
+        for i in range(requests):
+            (width, height) = random.choice(sizes)
+            path = "/render?location=%s&pack=%s&width=%d&height=%d&units=%s" % (
+                random.choice(locations), os.path.basename(pack_file), width,
+                height, random.choice(("us", "metric")))
+            start = time.time()
+            connection.request("GET", path)
+            response = connection.getresponse()
+            response.read()
+            latencies.append(time.time() - start)
+            if response.status != 200:
+                print "Request failed: %d %s" % (response.status, response.reason)
+        connection.close()
+
+    try:
+        for (name, cache_size) in (("render cache off", 0),
+                ("render cache on", 50)):
+            weatherpaper.AppSettings['render_cache_size'] = cache_size
+            latencies = []
+            threads = [threading.Thread(target=client, args=(latencies,))
+                for i in range(clients)]
+            start = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            seconds = time.time() - start
+
+            latencies.sort()
+            print "%s: %d requests, %.1f requests/s" % (name, len(latencies),
+                len(latencies) / seconds)
+            report("  p50 latency", percentile(latencies, 0.5))
+            report("  p99 latency", percentile(latencies, 0.99))
+    finally:
+        pywapi.YAHOO_WEATHER_URL = url
+        server.shutdown()
+        server.server_close()
+        # Close the pooled connections to the feed server, so its handler
+        # threads aren't left waiting on them while the interpreter exits
+        pywapi.set_connection_pool(pywapi.ConnectionPool())
+        feeds.shutdown()
+        feeds.server_close()
+
+# Available benchmarks and the arguments they take
+BENCHMARKS = {
+    'overlay': (benchOverlay, 1),
+    'scale': (benchScale, 1),
+    'decode': (benchDecode, 1),
+    'redraw': (benchRedraw, 1),
+    'borders': (benchBorders, 1),
+    'encode': (benchEncode, 1),
+    'zipread': (benchZipRead, 0),
+    'decrypt': (benchDecrypt, 0),
+    'extract': (benchExtract, 0),
+    'compress': (benchCompress, 0),
+    'feeds': (benchFeeds, 0),
+    'pool': (benchPool, 0),
+    'server': (benchServer, 1),
+}
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    if not args or args[0] not in BENCHMARKS \
+            or len(args) - 1 != BENCHMARKS[args[0]][1]:
+        print __doc__
+        sys.exit(1)
+
+    func = BENCHMARKS[args[0]][0]
+    func(*args[1:])
+
+
+if __name__ == "__main__":
+    main()
@@ -25,18 +25,585 @@
 Fetches weather reports from Google Weather, Yahoo Wheather and NOAA
 """
 
-import urllib2, string
-from xml.dom import minidom
+import os
+import sys
+import time
+import socket
+import hashlib
+import httplib
+import urllib
+import urllib2
+import urlparse
+import threading
+import Queue
+import asyncore
+import cPickle
+import cStringIO
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
 
 GOOGLE_WEATHER_URL = 'http://www.google.com/ig/api?weather=%s&hl=%s'
 
 YAHOO_WEATHER_URL = 'http://xml.weather.yahoo.com/forecastrss?p=%s&u=%s'
 YAHOO_WEATHER_NS = 'http://xml.weather.yahoo.com/ns/rss/1.0'
+YAHOO_GEO_NS = 'http://www.w3.org/2003/01/geo/wgs84_pos#'
 
 NOAA_WEATHER_URL = 'http://www.weather.gov/xml/current_obs/%s.xml'
 
 GISMETEO_WEATHER_URL = 'http://informer.gismeteo.ru/xml/%s.xml'
 
+# The cache used by the fetchers, see set_http_cache()
+_http_cache = None
+
+class HTTPCache:
+    """
+    An on-disk cache of weather feeds.
+
+    Each entry is a pickled dictionary holding the body of a response, its
+    ETag and Last-Modified validators and the time until which it may be
+    used without asking the server. Any object with the same get() and
+    put() methods can be passed to set_http_cache() instead.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def _entry(self, url):
+        return os.path.join(self.path, hashlib.sha1(url).hexdigest())
+
+    def get(self, url):
+        """
+        Returns the cached entry for url, or None if there is none
+        """
+        try:
+            f = open(self._entry(url), 'rb')
+            try:
+                return cPickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return None
+
+    def put(self, url, entry):
+        """
+        Stores entry as the cached response for url
+        """
+        path = self._entry(url)
+        f = open(path + '.tmp', 'wb')
+        try:
+            cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        try:
+            os.rename(path + '.tmp', path)
+        except OSError:
+            # Windows will not rename over an existing file
+            os.remove(path)
+            os.rename(path + '.tmp', path)
+
+
+def set_http_cache(cache):
+    """
+    Sets the cache used for all weather requests
+
+    Parameters:
+    cache: an HTTPCache, or None to always fetch feeds from the server
+    """
+    global _http_cache
+    _http_cache = cache
+
+def _cache_max_age(headers):
+    """
+    Returns how many seconds a response may be reused for according to its
+    Cache-Control header, 0 if it must be revalidated first, or None if it
+    must not be stored.
+    """
+    max_age = 0
+    for directive in headers.get('Cache-Control', '').split(','):
+        directive = directive.strip().lower()
+        if directive == 'no-store':
+            return None
+        elif directive == 'no-cache':
+            return 0
+        elif directive.startswith('max-age='):
+            try:
+                max_age = max(int(directive[8:]), 0)
+            except ValueError:
+                pass
+    return max_age
+
+def fetch_url(url):
+    """
+    Opens url, going through the cache set with set_http_cache().
+
+    A cached feed is returned without a request while it is fresh. Once it
+    is stale it is revalidated with If-None-Match and If-Modified-Since,
+    and a 304 Not Modified reply reuses the cached copy. Requests are sent
+    over the connection pool set with set_connection_pool().
+
+    Parameters:
+    url: the address of the feed
+
+    Returns: a file object containing the feed
+    """
+    cache = _http_cache
+    if cache is None:
+        return _open(url, {})
+
+    now = time.time()
+    entry = cache.get(url)
+    if entry is not None and now < entry['expires']:
+        return cStringIO.StringIO(entry['body'])
+
+    try:
+        handler = _open(url, _revalidation_headers(entry))
+    except urllib2.HTTPError, e:
+        if e.code != 304 or entry is None:
+            raise
+        body = entry['body']
+        _cache_response(cache, url, now, e.info(), body, entry)
+    else:
+        body = handler.read()
+        handler.close()
+        _cache_response(cache, url, now, handler.info(), body, None)
+    return cStringIO.StringIO(body)
+
+def _revalidation_headers(entry):
+    """
+    Returns the request headers that ask the server whether the cached
+    entry (which may be None) is still current
+    """
+    headers = {}
+    if entry is not None:
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+def _cache_response(cache, url, now, headers, body, entry):
+    """
+    Stores a response received at time now in the cache. For a 304 Not
+    Modified reply entry is the cached entry that was revalidated, for
+    anything else it is None.
+    """
+    max_age = _cache_max_age(headers)
+    if max_age is None:
+        return
+    if entry is None:
+        entry = {'etag': None, 'last_modified': None}
+    # A 304 may carry updated validators
+    cache.put(url, {
+        'body': body,
+        'etag': headers.get('ETag', entry['etag']),
+        'last_modified': headers.get('Last-Modified', entry['last_modified']),
+        'expires': now + max_age,
+        'fetched': now,
+    })
+
+def _keep_fresh(url, seconds):
+    """
+    Lets the cached copy of url be used without a request until seconds
+    after it was fetched. Reading the copy from the cache doesn't move
+    this on, so the feed is still fetched again once that time is up.
+    """
+    cache = _http_cache
+    if cache is None:
+        return
+    entry = cache.get(url)
+    if entry is None or 'fetched' not in entry:
+        return
+    expires = entry['fetched'] + seconds
+    if entry['expires'] < expires:
+        entry['expires'] = expires
+        cache.put(url, entry)
+
+
+class ConnectionPool:
+    """
+    Keeps connections to weather providers open between requests.
+
+    Up to size idle connections are kept for each host, and are shared by
+    all threads. Requests time out after timeout seconds. If per_host is
+    set, no more than that many requests are made to one host at a time.
+    """
+
+    # Status codes of redirects that are followed, and how many in a row
+    _REDIRECTS = (301, 302, 303, 307)
+    _MAX_REDIRECTS = 5
+
+    def __init__(self, size = 4, timeout = 30, per_host = None):
+        self.size = size
+        self.timeout = timeout
+        self.per_host = per_host
+        self.idle = {}
+        self.limits = {}
+        self.lock = threading.Lock()
+
+    def _connect(self, scheme, netloc):
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout = self.timeout)
+        return httplib.HTTPConnection(netloc, timeout = self.timeout)
+
+    def _acquire(self, key):
+        """
+        Returns an idle connection to a host, or None if there is none
+        """
+        self.lock.acquire()
+        try:
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop()
+            return None
+        finally:
+            self.lock.release()
+
+    def _limit(self, key):
+        """
+        Returns the semaphore limiting concurrent requests to a host, or
+        None if there is no limit
+        """
+        if self.per_host is None:
+            return None
+        self.lock.acquire()
+        try:
+            limit = self.limits.get(key)
+            if limit is None:
+                limit = threading.BoundedSemaphore(self.per_host)
+                self.limits[key] = limit
+            return limit
+        finally:
+            self.lock.release()
+
+    def _release(self, key, connection):
+        """
+        Returns a connection to the pool, closing it if the pool is full
+        """
+        self.lock.acquire()
+        try:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.size:
+                connections.append(connection)
+                return
+        finally:
+            self.lock.release()
+        connection.close()
+
+    def _request(self, scheme, netloc, path, headers):
+        """
+        Sends a GET request on a pooled connection and reads the response.
+        A reused connection that the server has since closed is replaced
+        by a new one.
+
+        Returns: a tuple of the response and its body
+        """
+        key = (scheme, netloc)
+        limit = self._limit(key)
+        if limit is not None:
+            limit.acquire()
+        try:
+            return self._send(key, path, headers)
+        finally:
+            if limit is not None:
+                limit.release()
+
+    def _send(self, key, path, headers):
+        (scheme, netloc) = key
+        connection = self._acquire(key)
+        reused = connection is not None
+        while True:
+            if connection is None:
+                connection = self._connect(scheme, netloc)
+            try:
+                connection.request('GET', path, headers = headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                connection.close()
+                if reused:
+                    connection = None
+                    reused = False
+                    continue
+                if isinstance(e, socket.error):
+                    raise urllib2.URLError(e)
+                raise
+            break
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(key, connection)
+        return (response, body)
+
+    def close(self):
+        """
+        Closes all idle connections
+        """
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = {}
+        finally:
+            self.lock.release()
+        for connections in idle.itervalues():
+            for connection in connections:
+                connection.close()
+
+    def urlopen(self, url, headers = {}):
+        """
+        Fetches url like urllib2.urlopen(), following redirects and raising
+        urllib2.HTTPError for error responses.
+
+        Parameters:
+        url: the address to fetch
+        headers: a dictionary of extra request headers
+
+        Returns: a file object containing the response body
+        """
+        for i in range(self._MAX_REDIRECTS + 1):
+            (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+            if query:
+                path += '?' + query
+            (response, body) = self._request(scheme, netloc, path or '/', headers)
+            location = response.getheader('Location')
+            if response.status not in self._REDIRECTS or not location:
+                break
+            url = urlparse.urljoin(url, location)
+
+        fp = cStringIO.StringIO(body)
+        if response.status >= 300:
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                response.msg, fp)
+        return urllib.addinfourl(fp, response.msg, url, response.status)
+
+
+# The connection pool used by the fetchers, see set_connection_pool()
+_connection_pool = ConnectionPool()
+
+def set_connection_pool(pool):
+    """
+    Sets the connection pool used for all weather requests
+
+    Parameters:
+    pool: a ConnectionPool, or None to open a new connection for every
+    request with urllib2
+    """
+    global _connection_pool
+    if _connection_pool is not None and _connection_pool is not pool:
+        _connection_pool.close()
+    _connection_pool = pool
+
+def _open(url, headers):
+    """
+    Fetches url through the connection pool, unless there is no pool or
+    the request has to go through a proxy, which only urllib2 handles.
+    """
+    pool = _connection_pool
+    (scheme, netloc) = urlparse.urlsplit(url)[:2]
+    if pool is None or scheme not in ('http', 'https') \
+            or _uses_proxy(scheme, netloc):
+        return urllib2.urlopen(urllib2.Request(url, headers = headers))
+    return pool.urlopen(url, headers)
+
+def _uses_proxy(scheme, netloc):
+    """
+    Returns whether requests to netloc over scheme go through a proxy
+    """
+    return bool(urllib.getproxies().get(scheme)) \
+        and not urllib.proxy_bypass(netloc)
+
+
+class AsyncFetch(asyncore.dispatcher):
+    """
+    Fetches a feed without blocking, driven by an asyncore loop.
+
+    The feed is parsed with parser and the result passed to
+    callback(weather_data, error). On success error is None; otherwise
+    weather_data is None and error is the exception that stopped the
+    fetch, such as urllib2.HTTPError, urllib2.URLError or socket.timeout.
+    The callback may be called before the constructor returns, for
+    example when the feed is fresh in the cache set with set_http_cache().
+
+    The timeout is checked each time the loop polls, so the loop should be
+    run with a timeout of its own, as in asyncore.loop(timeout = 1).
+    Requests are made directly rather than through the connection pool,
+    and only http URLs are supported. When a proxy is set for the URL the
+    feed is fetched with fetch_url() instead, which blocks, and the
+    callback is called before the constructor returns.
+    """
+
+    _REDIRECTS = (301, 302, 303, 307)
+    _MAX_REDIRECTS = 5
+
+    def __init__(self, url, parser, callback, timeout = 30, map = None,
+            redirects = 0):
+        asyncore.dispatcher.__init__(self, map = map)
+        self.url = url
+        self.parser = parser
+        self.callback = callback
+        self.timeout = timeout
+        self.deadline = time.time() + timeout
+        self.redirects = redirects
+        self.redirect = None
+        self.done = False
+        self.outgoing = ''
+        self.incoming = []
+
+        self.cache = _http_cache
+        self.entry = None
+        self.now = time.time()
+        if self.cache is not None:
+            self.entry = self.cache.get(url)
+            if self.entry is not None and self.now < self.entry['expires']:
+                self._parse(self.entry['body'])
+                return
+
+        (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+        if _uses_proxy(scheme, netloc):
+            # Only urllib2 knows how to talk to a proxy
+            self._fetch_blocking()
+            return
+        if scheme != 'http':
+            self._report(None, urllib2.URLError('unsupported scheme %s' % scheme))
+            return
+        if query:
+            path += '?' + query
+
+        request = ['GET %s HTTP/1.0' % (path or '/'), 'Host: %s' % netloc]
+        for header in _revalidation_headers(self.entry).iteritems():
+            request.append('%s: %s' % header)
+        self.outgoing = '\r\n'.join(request) + '\r\n\r\n'
+
+        (host, port) = urllib.splitnport(netloc, 80)
+        try:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.connect((host, port))
+        except socket.error, e:
+            self.close()
+            self._report(None, urllib2.URLError(e))
+
+    def close(self):
+        # Nothing to close if the feed came from the cache
+        if self.socket is not None:
+            asyncore.dispatcher.close(self)
+
+    def cancel(self):
+        """
+        Stops the fetch. The callback will not be called.
+        """
+        self.done = True
+        self.outgoing = ''
+        self.close()
+        if self.redirect is not None:
+            self.redirect.cancel()
+
+    def _fetch_blocking(self):
+        try:
+            handler = fetch_url(self.url)
+            body = handler.read()
+            handler.close()
+        except (urllib2.URLError, httplib.HTTPException), e:
+            self._report(None, e)
+        except socket.error, e:
+            if not isinstance(e, socket.timeout):
+                e = urllib2.URLError(e)
+            self._report(None, e)
+        else:
+            self._parse(body)
+
+    def _report(self, weather_data, error):
+        if not self.done:
+            self.done = True
+            self.callback(weather_data, error)
+
+    def _parse(self, body):
+        try:
+            weather_data = self.parser(cStringIO.StringIO(body))
+        except Exception, e:
+            self._report(None, e)
+        else:
+            self._report(weather_data, None)
+
+    def readable(self):
+        if not self.done and time.time() > self.deadline:
+            self.outgoing = ''
+            self.close()
+            self._report(None, socket.timeout('timed out'))
+        return not self.done
+
+    def writable(self):
+        return not self.done and (not self.connected or bool(self.outgoing))
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self.outgoing)
+        self.outgoing = self.outgoing[sent:]
+
+    def handle_read(self):
+        data = self.recv(8192)
+        if data:
+            self.incoming.append(data)
+
+    def handle_close(self):
+        self.close()
+        if not self.done:
+            self._response(''.join(self.incoming))
+
+    def handle_error(self):
+        if self.done:
+            # Raised by the callback, so leave it to whoever runs the loop
+            raise
+        self.close()
+        error = sys.exc_info()[1]
+        if isinstance(error, socket.error) \
+                and not isinstance(error, socket.timeout):
+            error = urllib2.URLError(error)
+        self._report(None, error)
+
+    def _response(self, response):
+        """
+        Handles the complete response once the server closes the connection
+        """
+        (head, body) = (response.split('\r\n\r\n', 1) + [''])[:2]
+        (status_line, head) = (head.split('\r\n', 1) + [''])[:2]
+        try:
+            (version, status, reason) = (status_line.split(None, 2) + [''])[:3]
+            status = int(status)
+        except ValueError:
+            self._report(None, httplib.BadStatusLine(status_line))
+            return
+        headers = httplib.HTTPMessage(cStringIO.StringIO(head))
+
+        location = headers.get('Location')
+        if status in self._REDIRECTS and location:
+            if self.redirects >= self._MAX_REDIRECTS:
+                self._report(None, urllib2.HTTPError(self.url, status,
+                    'too many redirects', headers, cStringIO.StringIO(body)))
+                return
+            self.done = True
+            self.redirect = AsyncFetch(urlparse.urljoin(self.url, location),
+                self.parser, self.callback, self.deadline - time.time(),
+                self._map, self.redirects + 1)
+        elif status == 304 and self.entry is not None:
+            _cache_response(self.cache, self.url, self.now, headers,
+                self.entry['body'], self.entry)
+            self._parse(self.entry['body'])
+        elif status >= 300:
+            self._report(None, urllib2.HTTPError(self.url, status, reason,
+                headers, cStringIO.StringIO(body)))
+        else:
+            if self.cache is not None:
+                _cache_response(self.cache, self.url, self.now, headers,
+                    body, None)
+            self._parse(body)
+
+
 def get_weather_from_google(location_id, hl = ''):
     """
     Fetches weather report from Google
@@ -50,34 +617,67 @@ def get_weather_from_google(location_id, hl = ''):
     """
 
     url = GOOGLE_WEATHER_URL % (location_id, hl)
-    handler = urllib2.urlopen(url)
-    dom = minidom.parse(handler)    
+    handler = fetch_url(url)
+    weather_data = parse_google(handler)
     handler.close()
 
-    weather_data = {}
-    weather_dom = dom.getElementsByTagName('weather')[0]
+    return weather_data
+
+def get_weather_from_google_async(callback, location_id, hl = '',
+        timeout = 30, map = None):
+    """
+    Fetches weather report from Google without blocking. See AsyncFetch for
+    how the result is passed to callback.
+
+    Returns: the AsyncFetch, which can be cancelled
+    """
+    url = GOOGLE_WEATHER_URL % (location_id, hl)
+    return AsyncFetch(url, parse_google, callback, timeout, map)
+
+def parse_google(source):
+    """
+    Parses a Google weather feed in a single pass
+
+    Parameters
+      source: a file name or file object containing the XML feed
+
+    Returns:
+      weather_data: a dictionary of weather data that exists in XML feed.
+      Fields missing from the feed are empty strings.
+    """
 
     data_structure = { 
         'forecast_information': ('city', 'postal_code', 'latitude_e6', 'longitude_e6', 'forecast_date', 'current_date_time', 'unit_system'),
         'current_conditions': ('condition','temp_f', 'temp_c', 'humidity', 'wind_condition', 'icon')
     }           
-    for (tag, list_of_tags2) in data_structure.iteritems():
-        tmp_conditions = {}
-        for tag2 in list_of_tags2:
-            tmp_conditions[tag2] =  weather_dom.getElementsByTagName(tag)[0].getElementsByTagName(tag2)[0].getAttribute('data')
-        weather_data[tag] = tmp_conditions
-
     forecast_conditions = ('day_of_week', 'low', 'high', 'icon', 'condition')
+
+    weather_data = {}
+    for (tag, list_of_tags2) in data_structure.iteritems():
+        weather_data[tag] = dict.fromkeys(list_of_tags2, '')
     forecasts = []
-    
-    for forecast in dom.getElementsByTagName('forecast_conditions'):
-        tmp_forecast = {}
-        for tag in forecast_conditions:
-            tmp_forecast[tag] = forecast.getElementsByTagName(tag)[0].getAttribute('data')
-        forecasts.append(tmp_forecast)
+
+    section = None
+    seen = set()
+    for (event, element) in xml_iterparse(source):
+        tag = element.tag
+        if event == 'end':
+            if tag in data_structure or tag == 'forecast_conditions':
+                section = None
+            continue
+
+        if tag in data_structure:
+            # Only the first section of each kind is used
+            if tag not in seen:
+                seen.add(tag)
+                section = weather_data[tag]
+        elif tag == 'forecast_conditions':
+            section = dict.fromkeys(forecast_conditions, '')
+            forecasts.append(section)
+        elif section is not None and tag in section and not section[tag]:
+            section[tag] = element.get('data', '')
 
     weather_data['forecasts'] = forecasts    
-    dom.unlink()
 
     return weather_data
     
@@ -99,18 +699,42 @@ def get_weather_from_yahoo(location_id, units = 'metric'):
     weather_data: a dictionary of weather data that exists in XML feed. See  http://developer.yahoo.com/weather/#channel
     """
 
+    url = _yahoo_url(location_id, units)
+    handler = fetch_url(url)
+    weather_data = parse_yahoo(handler)
+    handler.close()
+
+    return weather_data
+
+def get_weather_from_yahoo_async(callback, location_id, units = 'metric',
+        timeout = 30, map = None):
+    """
+    Fetches weather report from Yahoo! without blocking. See AsyncFetch for
+    how the result is passed to callback.
+
+    Returns: the AsyncFetch, which can be cancelled
+    """
+    url = _yahoo_url(location_id, units)
+    return AsyncFetch(url, parse_yahoo, callback, timeout, map)
+
+def _yahoo_url(location_id, units):
     if units == 'metric':
         unit = 'c'
     else:
         unit = 'f'
-    url = YAHOO_WEATHER_URL % (location_id, unit)
-    handler = urllib2.urlopen(url)
-    dom = minidom.parse(handler)    
-    handler.close()
-        
-    weather_data = {}
-    weather_data['title'] = dom.getElementsByTagName('title')[0].firstChild.data
-    weather_data['link'] = dom.getElementsByTagName('link')[0].firstChild.data
+    return YAHOO_WEATHER_URL % (location_id, unit)
+
+def parse_yahoo(source):
+    """
+    Parses a Yahoo! weather RSS feed in a single pass
+
+    Parameters
+    source: a file name or file object containing the RSS feed
+
+    Returns:
+    weather_data: a dictionary of weather data that exists in XML feed.
+    Fields missing from the feed are empty strings.
+    """
 
     ns_data_structure = { 
         'location': ('city', 'region', 'country'),
@@ -120,24 +744,68 @@ def get_weather_from_yahoo(location_id, units = 'metric'):
         'astronomy': ('sunrise', 'sunset'),
         'condition': ('text', 'code', 'temp', 'date')
     }       
-    
+    forecast_attrs = ('date', 'low', 'high', 'text', 'code')
+    ns_tags = {}
     for (tag, attrs) in ns_data_structure.iteritems():
-        weather_data[tag] = xml_get_ns_yahoo_tag(dom, YAHOO_WEATHER_NS, tag, attrs)
-
-    weather_data['geo'] = {}
-    weather_data['geo']['lat'] = dom.getElementsByTagName('geo:lat')[0].firstChild.data
-    weather_data['geo']['long'] = dom.getElementsByTagName('geo:long')[0].firstChild.data
+        ns_tags['{%s}%s' % (YAHOO_WEATHER_NS, tag)] = (tag, attrs)
+    forecast_tag = '{%s}forecast' % YAHOO_WEATHER_NS
 
-    weather_data['condition']['title'] = dom.getElementsByTagName('item')[0].getElementsByTagName('title')[0].firstChild.data
-    weather_data['html_description'] = dom.getElementsByTagName('item')[0].getElementsByTagName('description')[0].firstChild.data
-    
+    weather_data = {
+        'title': '',
+        'link': '',
+        'html_description': '',
+        'geo': {'lat': '', 'long': ''},
+    }
+    for (tag, attrs) in ns_data_structure.iteritems():
+        weather_data[tag] = dict.fromkeys(attrs, '')
+    weather_data['condition']['title'] = ''
     forecasts = []
-    for forecast in dom.getElementsByTagNameNS(YAHOO_WEATHER_NS, 'forecast'):
-        forecasts.append(xml_get_attrs(forecast,('date', 'low', 'high', 'text', 'code')))
+
+    # The first of each of these elements holds the value
+    text_tags = {
+        'title': (weather_data, 'title'),
+        'link': (weather_data, 'link'),
+        '{%s}lat' % YAHOO_GEO_NS: (weather_data['geo'], 'lat'),
+        '{%s}long' % YAHOO_GEO_NS: (weather_data['geo'], 'long'),
+    }
+    item_tags = {
+        'title': (weather_data['condition'], 'title'),
+        'description': (weather_data, 'html_description'),
+    }
+
+    in_item = False
+    seen = set()
+    for (event, element) in xml_iterparse(source):
+        tag = element.tag
+        if event == 'start':
+            if tag == 'item':
+                in_item = not ('item' in seen)
+                seen.add('item')
+            elif tag == forecast_tag:
+                forecasts.append(xml_get_attrs(element, forecast_attrs))
+            elif tag in ns_tags and tag not in seen:
+                seen.add(tag)
+                (name, attrs) = ns_tags[tag]
+                weather_data[name].update(xml_get_attrs(element, attrs))
+            continue
+
+        if tag == 'item':
+            in_item = False
+        elif in_item and tag in item_tags:
+            tags = item_tags
+            key = ('item', tag)
+        elif tag in text_tags:
+            tags = text_tags
+            key = tag
+        else:
+            continue
+        if key not in seen:
+            seen.add(key)
+            (result, name) = tags[tag]
+            result[name] = element.text or ''
+
     weather_data['forecasts'] = forecasts
     
-    dom.unlink()
-
     return weather_data
 
     
@@ -164,10 +832,49 @@ def get_weather_from_noaa(station_id):
     """
 
     url = NOAA_WEATHER_URL % (station_id)
-    handler = urllib2.urlopen(url)
-    dom = minidom.parse(handler)    
+    handler = fetch_url(url)
+    weather_data = parse_noaa(handler)
     handler.close()
-        
+
+    _keep_noaa_fresh(url, weather_data)
+    return weather_data
+
+def get_weather_from_noaa_async(callback, station_id, timeout = 30,
+        map = None):
+    """
+    Fetches weather report from NOAA without blocking. See AsyncFetch for
+    how the result is passed to callback.
+
+    Returns: the AsyncFetch, which can be cancelled
+    """
+    url = NOAA_WEATHER_URL % (station_id)
+
+    def done(weather_data, error):
+        if error is None:
+            _keep_noaa_fresh(url, weather_data)
+        callback(weather_data, error)
+
+    return AsyncFetch(url, parse_noaa, done, timeout, map)
+
+def _keep_noaa_fresh(url, weather_data):
+    # NOAA updates observations once per suggested_pickup_period minutes
+    try:
+        _keep_fresh(url, int(weather_data['suggested_pickup_period']) * 60)
+    except ValueError:
+        pass
+
+def parse_noaa(source):
+    """
+    Parses a NOAA current observation feed in a single pass
+
+    Parameter:
+    source: a file name or file object containing the XML feed
+
+    Returns:
+    weather_data: a dictionary of weather data that exists in XML feed. 
+    Fields missing from the feed are empty strings.
+    """
+
     data_structure = ('suggested_pickup',
                 'suggested_pickup_period',
                 'location',
@@ -203,12 +910,20 @@ def get_weather_from_noaa(station_id):
                 'two_day_history_url',
                 'ob_url'
                 )
-    weather_data = {}
-    current_observation = dom.getElementsByTagName('current_observation')[0]
-    for tag in data_structure:
-        weather_data[tag] = current_observation.getElementsByTagName(tag)[0].firstChild.data
+    weather_data = dict.fromkeys(data_structure, '')
+    seen = set()
+    depth = 0
+    for (event, element) in xml_iterparse(source):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        tag = element.tag
+        # Observations are the children of current_observation
+        if depth == 1 and tag in weather_data and tag not in seen:
+            seen.add(tag)
+            weather_data[tag] = element.text or ''
 
-    dom.unlink()
     return weather_data
     
 
@@ -229,10 +944,35 @@ def get_weather_from_gismeteo(location_id):
     """
     
     url = GISMETEO_WEATHER_URL % (location_id)
-    handler = urllib2.urlopen(url)
-    dom = minidom.parse(handler)
+    handler = fetch_url(url)
+    weather_data = parse_gismeteo(handler)
     handler.close()
-    
+
+    return weather_data
+
+def get_weather_from_gismeteo_async(callback, location_id, timeout = 30,
+        map = None):
+    """
+    Fetches weather report from GisMeteo without blocking. See AsyncFetch
+    for how the result is passed to callback.
+
+    Returns: the AsyncFetch, which can be cancelled
+    """
+    url = GISMETEO_WEATHER_URL % (location_id)
+    return AsyncFetch(url, parse_gismeteo, callback, timeout, map)
+
+def parse_gismeteo(source):
+    """
+    Parses a GisMeteo informer feed in a single pass
+
+    Parameters
+    source: a file name or file object containing the XML feed
+
+    Returns:
+    weather_data: a dictionary of weather data(forecasts only, not current weather) that exists in XML feed.
+    Fields missing from the feed are empty strings.
+    """
+
     forecast_data_structure = {
         'PHENOMENA': ('cloudiness','precipitation', 'rpower', 'spower'),
         'PRESSURE': ('max','min'),
@@ -244,27 +984,99 @@ def get_weather_from_gismeteo(location_id):
     town_tag_attr = ('index', 'sname', 'latitude','longitude')
     forecast_tag_attr = ('day', 'month', 'year', 'hour', 'tod', 'predict', 'weekday')
     
-    weather_data = {}
-
-    weather_data['town'] = xml_get_attrs(dom.getElementsByTagName('TOWN')[0], town_tag_attr)
-
+    weather_data = {'town': dict.fromkeys(town_tag_attr, '')}
     forecasts = []
-    xml_forecats_node  = dom.getElementsByTagName('FORECAST')
 
-    for i in range(xml_forecats_node.length):
-        forecast = xml_forecats_node.item(i)
-        _tmp_forecast = {}
-        _tmp_forecast.update(xml_get_attrs(forecast, forecast_tag_attr))                
-        for (tag, attrs) in forecast_data_structure.iteritems():
-            _tmp_forecast[string.lower(tag)] = xml_get_attrs(forecast.getElementsByTagName(tag)[0], attrs)
-        forecasts.append(_tmp_forecast)
+    forecast = None
+    seen = set()
+    for (event, element) in xml_iterparse(source):
+        if event == 'end':
+            if element.tag == 'FORECAST':
+                forecast = None
+            continue
+
+        tag = element.tag
+        if tag == 'TOWN':
+            if tag not in seen:
+                seen.add(tag)
+                weather_data['town'] = xml_get_attrs(element, town_tag_attr)
+        elif tag == 'FORECAST':
+            forecast = xml_get_attrs(element, forecast_tag_attr)
+            for (tag, attrs) in forecast_data_structure.iteritems():
+                forecast[tag.lower()] = dict.fromkeys(attrs, '')
+            forecasts.append(forecast)
+            seen.difference_update(forecast_data_structure)
+        elif forecast is not None and tag in forecast_data_structure \
+                and tag not in seen:
+            seen.add(tag)
+            forecast[tag.lower()] = xml_get_attrs(element, forecast_data_structure[tag])
 
-    dom.unlink()
     weather_data['forecasts'] = forecasts
 
     return weather_data
 
 
+# The fetcher for each provider name accepted by get_weather_batch()
+_PROVIDERS = {
+    'google': get_weather_from_google,
+    'yahoo': get_weather_from_yahoo,
+    'noaa': get_weather_from_noaa,
+    'gismeteo': get_weather_from_gismeteo,
+}
+
+def get_weather_batch(provider, location_ids, workers = 8, **kwargs):
+    """
+    Fetches weather reports for many locations at once
+
+    Parameters:
+    provider: 'google', 'yahoo', 'noaa' or 'gismeteo'
+    location_ids: the locations (or NOAA station IDs) to fetch. Each
+    location is only fetched once, however often it is listed.
+    workers: how many reports are fetched at the same time. To also limit
+    requests per host, use a ConnectionPool with per_host set.
+    Any other keyword arguments are passed on to the provider's fetcher,
+    for example units for Yahoo!.
+
+    Returns:
+    (results, errors): results is a dictionary of the weather data of each
+    location that was fetched, errors a dictionary of the exception raised
+    for each location that could not be.
+    """
+
+    fetcher = _PROVIDERS[provider]
+
+    queue = Queue.Queue()
+    seen = set()
+    for location_id in location_ids:
+        if location_id not in seen:
+            seen.add(location_id)
+            queue.put(location_id)
+
+    results = {}
+    errors = {}
+
+    def worker():
+        while True:
+            try:
+                location_id = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[location_id] = fetcher(location_id, **kwargs)
+            except Exception, e:
+                errors[location_id] = e
+
+    threads = []
+    for i in range(min(workers, len(seen))):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    return (results, errors)
+
+
     
 def xml_get_ns_yahoo_tag(dom, YAHOO_WEATHER_NS, tag, attrs):
     """
@@ -294,6 +1106,35 @@ def xml_get_attrs(xml_element, attrs):
     """
     
     result = {}
-    for attr in attrs:
-        result[attr] = xml_element.getAttribute(attr)   
+    if hasattr(xml_element, 'getAttribute'):
+        for attr in attrs:
+            result[attr] = xml_element.getAttribute(attr)   
+    else:
+        for attr in attrs:
+            result[attr] = xml_element.get(attr, '')
     return result
+
+
+def xml_iterparse(source):
+    """
+    Yields the ('start', element) and ('end', element) events of an XML
+    document, discarding each element once its end has been seen so that
+    memory use does not grow with the size of the document.
+
+    Parameters:
+    source: a file name or file object
+
+    Returns: an iterator of (event, element) pairs
+    """
+
+    context = iterparse(source, events=('start', 'end'))
+    root = None
+    for (event, element) in context:
+        if root is None:
+            root = element
+        yield (event, element)
+        if event == 'end':
+            element.clear()
+            if element is not root:
+                # Drop the finished element from the tree as well
+                root.clear()
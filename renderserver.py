@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+
+#Copyright (c) 2009 Steven Nichols <Steven@Steven-Nichols.com>
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+
+"""
+Serves weather wallpapers rendered to order for many clients.
+
+Usage:
+    renderserver.py [options] packs_dir
+
+A client asks for a wallpaper with
+
+    GET /render?location=USNY0996&pack=tango.zip&width=1280&height=800&units=metric
+
+and receives it as a JPEG. pack names a wallpaper pack in packs_dir; units
+is "metric" or "us". Wallpaper packs, decoded images, rendered wallpapers
+and weather reports are shared by all clients, and wallpapers are rendered
+on a fixed pool of worker threads.
+"""
+
+import os
+import sys
+import time
+import socket
+import urllib2
+import urlparse
+import threading
+import Queue
+import cStringIO
+import optparse
+import BaseHTTPServer
+import SocketServer
+
+import weatherpaper
+import pywapi
+
+# Largest width or height that may be asked for
+_MAX_SIZE = 8192
+
+# The format rendered wallpapers are sent in. The JPEG options come from
+# the output settings.
+_OUTPUT_FORMAT = "jpeg"
+_CONTENT_TYPE = "image/jpeg"
+
+class NoSuchPack(Exception):
+    """Raised when a client asks for a pack that isn't in the directory"""
+
+
+class PackRegistry:
+    """The wallpaper packs in a directory, each opened the first time it is
+    asked for and then shared by all clients. A pack is reloaded when it
+    changes on disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.packs = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """Return the open pack with the given file name. Raises NoSuchPack
+        if there is no such pack.
+
+        """
+        if name != os.path.basename(name) or name.startswith('.'):
+            raise NoSuchPack(name)
+
+        self.lock.acquire()
+        try:
+            path = os.path.join(self.path, name)
+            pack = self.packs.get(name)
+            if not os.path.isfile(path):
+                if pack is not None:
+                    pack.close()
+                    del self.packs[name]
+                raise NoSuchPack(name)
+
+            try:
+                if pack is None:
+                    pack = weatherpaper.WallpaperPack(path)
+                elif not pack.refresh():
+                    return pack
+                # Parse the pack's files once, before clients share it
+                pack.getIndex()
+                pack.getOverlay()
+            except:
+                # Open it again on the next request, which may come after
+                # the file has been completely written
+                self.packs.pop(name, None)
+                raise
+            self.packs[name] = pack
+            return pack
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for pack in self.packs.itervalues():
+                pack.close()
+            self.packs = {}
+        finally:
+            self.lock.release()
+
+
+class WeatherCache:
+    """Weather reports shared by all clients. Each report is fetched at most
+    once every max_age seconds, however many clients ask for it at once.
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.reports = {}
+        self.fetching = {}
+        self.lock = threading.Lock()
+
+    def get(self, location_id, metric):
+        """Return the Yahoo! weather report for a location. Raises the
+        fetcher's exception if it could not be fetched.
+
+        """
+        key = (location_id, metric)
+        while True:
+            self.lock.acquire()
+            try:
+                report = self.reports.get(key)
+                if report is not None and time.time() < report[0]:
+                    return report[1]
+                fetch = self.fetching.get(key)
+                if fetch is None:
+                    # This thread fetches the report; others wait for it
+                    fetch = self.fetching[key] = {
+                        'done': threading.Event(),
+                        'error': None,
+                    }
+                    break
+            finally:
+                self.lock.release()
+
+            fetch['done'].wait()
+            if fetch['error'] is not None:
+                raise fetch['error']
+
+        try:
+            weather = pywapi.get_weather_from_yahoo(location_id,
+                'metric' if metric else '')
+        except Exception, e:
+            fetch['error'] = e
+            raise
+        else:
+            self.lock.acquire()
+            try:
+                self.reports[key] = (time.time() + self.max_age, weather)
+            finally:
+                self.lock.release()
+            return weather
+        finally:
+            self.lock.acquire()
+            try:
+                del self.fetching[key]
+            finally:
+                self.lock.release()
+            fetch['done'].set()
+
+
+class RenderPool:
+    """A fixed number of threads that run render jobs"""
+
+    def __init__(self, workers):
+        self.jobs = Queue.Queue()
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                job['result'] = job['func'](*job['args'])
+            except:
+                job['error'] = sys.exc_info()
+            job['done'].set()
+
+    def run(self, func, *args):
+        """Run func(*args) on a worker thread and return its result, or
+        raise the exception it raised.
+
+        """
+        job = {
+            'func': func,
+            'args': args,
+            'done': threading.Event(),
+            'error': None,
+        }
+        self.jobs.put(job)
+        job['done'].wait()
+        if job['error'] is not None:
+            raise job['error'][0], job['error'][1], job['error'][2]
+        return job['result']
+
+
+class Renderer:
+    """Renders wallpapers for any location, pack, size and units"""
+
+    def __init__(self, packs, weather, settings):
+        self.packs = packs
+        self.weather = weather
+        self.settings = settings
+        self.encoder = weatherpaper.getOutputEncoder(
+            dict(settings, output_format=_OUTPUT_FORMAT))
+
+        # Thresholds in the settings are in Fahrenheit
+        self.metricSettings = dict(settings)
+        for name in ('hot_threshold', 'cold_threshold'):
+            self.metricSettings[name] = int(round(
+                weatherpaper.getCelcius(settings[name])))
+
+    def getStatus(self, location_id, metric):
+        """Return the weather status for a location, or the error status if
+        the weather could not be fetched.
+
+        """
+        try:
+            weather = self.weather.get(location_id, metric)
+        except (urllib2.URLError, socket.timeout):
+            return {
+                'code': weatherpaper._WEATHER_ERROR_CODE,
+                'errormsg': 'Could Not Connect',
+            }
+
+        WStatus = {}
+        if metric:
+            weatherpaper.setWeatherStatus(WStatus, weather, self.metricSettings)
+        else:
+            weatherpaper.setWeatherStatus(WStatus, weather, self.settings)
+        return WStatus
+
+    def render(self, location_id, pack_name, size, metric):
+        """Return a rendered wallpaper as a string of JPEG data"""
+        pack = self.packs.get(pack_name)
+        WStatus = self.getStatus(location_id, metric)
+
+        wallpaper = weatherpaper.getWallpaper(WStatus['code'], pack)
+        WStatus['title'] = wallpaper.title
+        WStatus['author'] = wallpaper.author
+        WStatus['filename'] = wallpaper.file
+
+        plan = pack.getOverlay()
+        texts = weatherpaper.getOverlayTexts(plan, WStatus)
+        cache = weatherpaper.getRenderCache()
+        key = weatherpaper.getRenderKey(WStatus, texts, pack, size,
+            self.encoder)
+        data = cache.read(key, self.encoder.extension)
+        if data is not None:
+            return data
+
+        image = weatherpaper.getBaseImage(WStatus['filename'], pack, size)
+        weatherpaper.renderOverlay(image, plan, texts)
+        output = cStringIO.StringIO()
+        image.save(output, self.encoder.format, **self.encoder.options)
+        data = output.getvalue()
+        cache.write(key, self.encoder.extension, data)
+        return data
+
+
+class RenderRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers GET /render requests"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        (path, query) = urlparse.urlsplit(self.path)[2:4]
+        if path != '/render':
+            self.send_error(404)
+            return
+
+        params = urlparse.parse_qs(query)
+        try:
+            location_id = params['location'][0]
+            pack_name = params['pack'][0]
+            size = (int(params['width'][0]), int(params['height'][0]))
+            units = params.get('units', ['us'])[0]
+        except (KeyError, ValueError):
+            self.send_error(400, "location, pack, width and height are required")
+            return
+        if not (0 < size[0] <= _MAX_SIZE and 0 < size[1] <= _MAX_SIZE):
+            self.send_error(400, "Unsupported size")
+            return
+        if units not in ('metric', 'us'):
+            self.send_error(400, "units must be metric or us")
+            return
+
+        try:
+            data = self.server.pool.run(self.server.renderer.render,
+                location_id, pack_name, size, units == 'metric')
+        except NoSuchPack:
+            self.send_error(404, "No such pack")
+            return
+        except (Exception, SystemExit):
+            # The renderer calls exit() on a broken pack, which mustn't take
+            # the connection down without an answer
+            self.log_error("Could not render %s: %r", self.path, sys.exc_info()[1])
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", _CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Clients on a Unix socket have no address
+        if isinstance(self.client_address, tuple):
+            return BaseHTTPServer.BaseHTTPRequestHandler.address_string(self)
+        return "local"
+
+    def log_message(self, format, *args):
+        sys.stderr.write("%s - - [%s] %s\n" % (self.address_string(),
+            self.log_date_time_string(), format % args))
+
+    def log_request(self, code='-', size='-'):
+        # Only errors are logged
+        pass
+
+
+class RenderServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves wallpapers over TCP. Each connection is handled on its own
+    thread, while rendering is done by the pool.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, renderer, pool):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RenderRequestHandler)
+        self.renderer = renderer
+        self.pool = pool
+
+
+class UnixRenderServer(RenderServer):
+    """Serves wallpapers on a Unix socket"""
+
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # Remove the socket left behind by a previous server
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        SocketServer.TCPServer.server_bind(self)
+        self.server_name = self.server_address
+        self.server_port = 0
+
+
+def createServer(packs_dir, address, workers, max_age):
+    """Return a server for the packs in packs_dir, listening on address: a
+    (host, port) tuple, or the path of a Unix socket.
+
+    """
+    settings = weatherpaper.getDefaultSettings()
+    weatherpaper.AppSettings = settings
+    # Create the shared caches before there are threads to race for them
+    weatherpaper.getRenderCache()
+    weatherpaper.getImageCache()
+
+    renderer = Renderer(PackRegistry(packs_dir), WeatherCache(max_age), settings)
+    pool = RenderPool(workers)
+    if isinstance(address, tuple):
+        return RenderServer(address, renderer, pool)
+    return UnixRenderServer(address, renderer, pool)
+
+def cpuCount():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = optparse.OptionParser(usage="%prog [options] packs_dir")
+    parser.add_option("-b", "--bind", default="127.0.0.1",
+        help="address to listen on [%default]")
+    parser.add_option("-p", "--port", type="int", default=8080,
+        help="port to listen on [%default]")
+    parser.add_option("-s", "--socket",
+        help="listen on this Unix socket instead of a port")
+    parser.add_option("-w", "--workers", type="int", default=cpuCount(),
+        help="number of render threads [%default]")
+    parser.add_option("-r", "--refresh", type="int",
+        default=weatherpaper.getDefaultSettings()['refresh_delay'],
+        help="minutes a weather report is reused for [%default]")
+    (options, args) = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("a directory of wallpaper packs is required")
+
+    # Keep weather feeds on disk, as the desktop program does
+    pywapi.set_http_cache(pywapi.HTTPCache(os.path.join(
+        weatherpaper._PROG_WORKING_DIR, weatherpaper._FEED_CACHE_DIR)))
+
+    if options.socket:
+        address = options.socket
+    else:
+        address = (options.bind, options.port)
+    server = createServer(args[0], address, options.workers,
+        options.refresh * 60)
+    print "Serving wallpapers on %s" % (address,)
+    try:
+        server.serve_forever()
+    finally:
+        server.renderer.packs.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -33,10 +33,21 @@ import random
 import math
 import time
 import string
-from datetime import datetime, timedelta
+import re
+import hashlib
+import cStringIO
 import urllib2
+import socket
+import heapq
+import asyncore
+import thread
+import threading
+import struct
+import ctypes
+import ctypes.util
 import shutil
 from xml.etree.ElementTree import parse
+from collections import namedtuple
 import ConfigParser
 import zipfile
 
@@ -44,6 +55,7 @@ import pywapi
 import Image
 import ImageDraw
 import ImageFont
+import ImageFilter
 #import TextOverlay
 
 #from SingleInstance import *
@@ -60,6 +72,61 @@ _DEFAULT_FONT = "arialbd.ttf"
 _DEFAULT_FONT_SIZE = 14
 _DEFAULT_FONT_COLOR = "black"
 _WEATHER_ERROR_CODE = "-1"
+_RENDER_CACHE_DIR = "cache"
+_FEED_CACHE_DIR = "feeds"
+# Seconds between checks of the settings file and wallpaper pack for
+# changes, where inotify is not available
+_SETTINGS_CHECK_INTERVAL = 60
+# Seconds to wait after a file changes before reloading it, so that one save
+# that causes several events only reloads once
+_WATCH_DELAY = 0.5
+# Seconds to wait before trying again when the weather can't be fetched
+_RETRY_DELAY = 5
+# The longest the main loop sleeps, and by how many more seconds the clock
+# may move during a sleep before it is taken to have jumped
+_MAX_SLEEP = 300
+_CLOCK_JUMP = 30
+# The longest the main loop waits while a weather fetch is in progress, as
+# fetches only check whether they have timed out between waits
+_FETCH_POLL = 1
+
+# Settings that may be left out of the settings file, and their defaults
+_SETTINGS_DEFAULTS = {
+    'render_cache_size': '50',
+    'image_cache_size': '64',
+    # XP does not support image types other than BMP
+    'output_format': 'bmp' if platform.release() == "XP" else 'jpeg',
+    'output_quality': '85',
+    'output_subsampling': '4:2:0',
+    'output_optimize': 'no',
+    'output_progressive': 'no',
+    'output_compress_level': '1',
+}
+
+# Settings that need the weather fetched again when they change
+_FETCH_SETTINGS = ('location_id', 'metric_units', 'refresh_delay')
+# Settings that need a new wallpaper chosen for the current weather
+_SELECT_SETTINGS = ('wallpaper_pack', 'hot_threshold', 'cold_threshold',
+    'use_feels_like')
+# Settings that only need the wallpaper drawn again. The cache sizes are
+# picked up the next time the caches are used.
+_RENDER_SETTINGS = ('overlay_enabled', 'screen_width', 'screen_height',
+    'output_format', 'output_quality', 'output_subsampling', 'output_optimize',
+    'output_progressive', 'output_compress_level')
+
+# Formats the wallpaper may be saved in, by their name in the settings file,
+# and the PIL format and file extension used for each. PPM is uncompressed,
+# for compositors that would rather not decode anything.
+_OUTPUT_FORMATS = {
+    'jpeg': ('JPEG', '.jpg'),
+    'png': ('PNG', '.png'),
+    'bmp': ('BMP', '.bmp'),
+    'ppm': ('PPM', '.ppm'),
+}
+# Other names accepted for the output formats
+_OUTPUT_FORMAT_ALIASES = {'jpg': 'jpeg'}
+# JPEG chroma subsampling, by the number PIL uses for it
+_JPEG_SUBSAMPLING = {'4:4:4': 0, '4:2:2': 1, '4:2:0': 2}
 
 if(sys.platform == 'win32'):
     _PROG_WORKING_DIR = os.path.join(os.environ['APPDATA'], "WeatherPaper")
@@ -72,14 +139,29 @@ else:
         _PROG_WORKING_DIR = fullpath
         
     _TEMP_DIR = os.path.join("/tmp", "weatherpaper")
-if platform.release() == "XP":
-    _OUTPUT_FILE = "wallpaper.bmp"
-else:
-    _OUTPUT_FILE = "wallpaper.jpg"
-    
+# The wallpaper file, without the extension of the output format
+_OUTPUT_NAME = "wallpaper"
+
 # Global settings dictionary
 AppSettings = {}
 
+# A wallpaper listed in the pack's meta data file
+WallpaperInfo = namedtuple('WallpaperInfo', 'title author file')
+
+# A line of text from the overlay file, compiled ready for drawing.
+# error is True for lines that are only drawn when there is an error.
+OverlayLine = namedtuple('OverlayLine',
+    'error template x y font fill align border bordercolor')
+
+# How the wallpaper is saved: the PIL format, the file extension and the
+# keyword options passed to Image.save()
+OutputEncoder = namedtuple('OutputEncoder', 'format extension options')
+
+# Names that may be placed between "%" signs in the overlay file
+_WEATHER_FIELDS = ('title', 'author', 'temp', 'degree', 'unit', 'condition',
+    'humidity', 'date', 'forecast', 'feelslike')
+_ERROR_FIELDS = ('errormsg',)
+
 def detectOS():
     # this was adapted from:
     # http://gitweb.compiz-fusion.org/?p=fusion/misc/compiz-manager;a=blob;f=compiz-manager
@@ -95,7 +177,7 @@ def loadSettings():
     settings file.
 
     """    
-    config = ConfigParser.RawConfigParser()
+    config = ConfigParser.RawConfigParser(_SETTINGS_DEFAULTS)
     config.read(os.path.join(_PROG_WORKING_DIR, _PROG_SETTINGS_FILE))
     
     s = {}
@@ -112,6 +194,25 @@ def loadSettings():
     s['wallpaper_pack'] = os.path.join(_PROG_WORKING_DIR, config.get('General', 'wallpaper_pack'))
     #s['symlink_enabled'] = config.getboolean('General', 'symlink_enabled')
     s['overlay_enabled'] = config.getboolean('General', 'overlay_enabled')
+    s['render_cache_size'] = config.getint('General', 'render_cache_size')
+    s['image_cache_size'] = config.getint('General', 'image_cache_size')
+    s['output_format'] = config.get('General', 'output_format').lower()
+    s['output_quality'] = config.getint('General', 'output_quality')
+    s['output_subsampling'] = config.get('General', 'output_subsampling')
+    s['output_optimize'] = config.getboolean('General', 'output_optimize')
+    s['output_progressive'] = config.getboolean('General', 'output_progressive')
+    s['output_compress_level'] = config.getint('General', 'output_compress_level')
+
+    # An unknown value shouldn't stop the program or, at startup, get the
+    # settings file replaced with the defaults
+    s['output_format'] = _OUTPUT_FORMAT_ALIASES.get(s['output_format'],
+        s['output_format'])
+    for (name, values) in (('output_format', _OUTPUT_FORMATS),
+            ('output_subsampling', _JPEG_SUBSAMPLING)):
+        if s[name] not in values:
+            print "Unknown %s %s in settings file, using %s" % (name,
+                s[name], _SETTINGS_DEFAULTS[name])
+            s[name] = _SETTINGS_DEFAULTS[name]
     
     return s
     
@@ -121,6 +222,14 @@ def saveSettings(s):
     
     config.add_section('General')
 
+    config.set('General', 'output_compress_level', s['output_compress_level'])
+    config.set('General', 'output_progressive', s['output_progressive'])
+    config.set('General', 'output_optimize', s['output_optimize'])
+    config.set('General', 'output_subsampling', s['output_subsampling'])
+    config.set('General', 'output_quality', s['output_quality'])
+    config.set('General', 'output_format', s['output_format'])
+    config.set('General', 'image_cache_size', s['image_cache_size'])
+    config.set('General', 'render_cache_size', s['render_cache_size'])
     config.set('General', 'overlay_enabled', s['overlay_enabled'])
     config.set('General', 'wallpaper_pack', s['wallpaper_pack'])
     config.set('General', 'use_feels_like', s['use_feels_like'])
@@ -134,8 +243,8 @@ def saveSettings(s):
     
     config.write(open(os.path.join(_PROG_WORKING_DIR, _PROG_SETTINGS_FILE), "wb"))
 
-def writeNewSettings():
-    """ Creates a brand-new settings file """
+def getDefaultSettings():
+    """ Returns the settings used when there is no settings file """
     s = {}
     
     s['location_id'] = "USFL0378"
@@ -149,8 +258,20 @@ def writeNewSettings():
     s['wallpaper_pack'] = "tango.zip"
     #s['symlink_enabled'] = False
     s['overlay_enabled'] = True
+    s['render_cache_size'] = 50
+    s['image_cache_size'] = 64
+    s['output_format'] = _SETTINGS_DEFAULTS['output_format']
+    s['output_quality'] = 85
+    s['output_subsampling'] = '4:2:0'
+    s['output_optimize'] = False
+    s['output_progressive'] = False
+    s['output_compress_level'] = 1
     
-    saveSettings(s)
+    return s
+
+def writeNewSettings():
+    """ Creates a brand-new settings file """
+    saveSettings(getDefaultSettings())
     
 def getFahrenheit(tempC):
     """Convert degrees Celcius to degrees Fahrenheit"""
@@ -160,11 +281,18 @@ def getCelcius(tempF):
     """Convert degrees Fahrenheit to degrees Celcius"""
     return (tempF - 32) * (5.0/9.0)
     
-def getHeatIndex(temp, humidity):
-    """Calculate what a given temperature feels like"""
+def getHeatIndex(temp, humidity, metric=None):
+    """Calculate what a given temperature feels like. The temperature is in
+    Celcius if metric is True, and in the units from the settings if metric
+    is None.
+
+    """
     global AppSettings
+    if metric is None:
+        metric = AppSettings['metric_units']
+
     # Convert temperature to Fahrenheit if needed
-    if AppSettings['metric_units']:
+    if metric:
         tempF = getFahrenheit(int(temp))
     else:
         tempF = int(temp)
@@ -183,130 +311,587 @@ def getHeatIndex(temp, humidity):
          (0.00085282 * tempF * humidity**2) + (-0.00000199 * tempF**2 * humidity**2))
     
     # Convert back to Celcius if needed
-    if AppSettings['metric_units']:
+    if metric:
         heat_index = round(getCelcius(heat_index),0)
     
     return int(heat_index)
 
+def setWeatherStatus(WStatus, weather, settings):
+    """Fill in WStatus from a Yahoo! weather report. The weather code is
+    replaced with HOT or COLD when the temperature is past the thresholds
+    in settings.
+
+    """
+    WStatus['date'] = weather['condition']['date']
+    WStatus['code'] = weather['condition']['code']
+    WStatus['temp'] = weather['condition']['temp']
+    WStatus['condition'] = weather['condition']['text']
+    WStatus['humidity'] = weather['atmosphere']['humidity']
+    WStatus['wind_chill'] = weather['wind']['chill']
+    WStatus['forecast'] = weather['forecasts'][0]['text']
+    WStatus['temp_unit'] = weather['units']['temperature']
+
+    # Feels like temperature
+    if (WStatus['temp_unit'] == 'F' and int(WStatus['temp']) > 80) \
+      or (WStatus['temp_unit'] == 'C' and int(WStatus['temp']) > 27):
+        WStatus['feels_like'] = getHeatIndex(WStatus['temp'], WStatus['humidity'],
+            WStatus['temp_unit'] == 'C')
+    elif (WStatus['temp_unit'] == 'F' and int(WStatus['temp']) < 50) \
+      or (WStatus['temp_unit'] == 'C' and int(WStatus['temp']) < 10):
+        WStatus['feels_like'] = WStatus['wind_chill']
+    else:
+        WStatus['feels_like'] = WStatus['temp']
+
+    # Force a change the weather code
+    if settings['use_feels_like']:
+        if int(WStatus['feels_like']) >= settings['hot_threshold']:
+            WStatus['code'] = '36' # HOT!
+        elif int(WStatus['feels_like']) <= settings['cold_threshold']:
+            WStatus['code'] = '25' # COLD!
+    else:
+        if int(WStatus['temp']) >= settings['hot_threshold']:
+            WStatus['code'] = '36' # HOT!
+        elif int(WStatus['temp']) <= settings['cold_threshold']:
+            WStatus['code'] = '25' # COLD!
+
+
+class WallpaperPack:
+    """An open wallpaper pack.
+
+    The archive is opened once and its central directory is kept in memory
+    across refresh cycles. It is only re-read when the size or modification
+    time of the pack file changes.
+
+    If useMmap is True the archive is memory mapped, which saves copying
+    stored members. Only use it when the pack file is replaced by renaming
+    a new one over it: rewriting the file in place while it is mapped can
+    crash the interpreter with SIGBUS.
+    """
+
+    def __init__(self, path, useMmap=False):
+        self.path = path
+        self.useMmap = useMmap
+        self.zf = None
+        self.stat = None
+        self.folder = ''
+        self.index = None
+        self.fonts = {}
+        self.fontFiles = {}
+        self.overlay = None
+        self.reload()
+
+    def _stat(self):
+        st = os.stat(self.path)
+        return (st.st_mtime, st.st_size)
+
+    def reload(self):
+        """(Re)open the archive and read its table of contents"""
+        if self.zf is not None:
+            self.zf.close()
+
+        self.stat = self._stat()
+        self.zf = zipfile.ZipFile(self.path, "r", useMmap=self.useMmap)
+
+        # If files are contained in a directory
+        self.folder = os.path.dirname(self.zf.namelist()[0])
+        print "Loaded wallpaper pack %s" % self.path
+
+        # Anything read from the previous archive is now stale
+        self.index = None
+        self.fonts = {}
+        self.fontFiles = {}
+        self.overlay = None
+
+    def refresh(self):
+        """Reload the archive if the pack file has changed on disk.
+        Returns True if the pack was reloaded.
+
+        """
+        if self._stat() != self.stat:
+            print "Change to wallpaper pack detected"
+            self.reload()
+            return True
+        return False
+
+    def close(self):
+        if self.zf is not None:
+            self.zf.close()
+            self.zf = None
+
+    def member(self, filename):
+        """Return the name of a file within the archive"""
+        if len(self.folder) != 0:
+            return self.folder + "/" + filename
+        return filename
+
+    def getinfo(self, filename):
+        return self.zf.getinfo(self.member(filename))
+
+    def open(self, filename):
+        return self.zf.open(self.member(filename))
+
+    def read(self, filename):
+        """Return the contents of a file in the pack as a string or, where
+        it can be read without copying, a buffer.
+
+        """
+        return self.zf.getbuffer(self.member(filename))
+
+    def extract(self, filename):
+        """Extract a file to the temporary directory and return its path"""
+        member = self.member(filename)
+        return self.zf.extract(member, _TEMP_DIR)
+
+    def extractFont(self, filename):
+        """Return the path to a font file from the pack. Each font is only
+        extracted the first time it is used.
+
+        """
+        path = self.fontFiles.get(filename)
+        if path is None:
+            path = self.extract(filename)
+            self.fontFiles[filename] = path
+        return path
+
+    def _loadFont(self, filename, size):
+        try:
+            # Load the font straight from memory
+            return ImageFont.truetype(cStringIO.StringIO(self.read(filename)), size)
+        except TypeError:
+            # Older versions of PIL can only load fonts from a file
+            return ImageFont.truetype(self.extractFont(filename), size)
+
+    def getFont(self, filename, size, packed=True):
+        """Return a font object for a font file in the pack, or for the font
+        file at the path filename if packed is False. Fonts are only loaded
+        the first time each font and size are used.
+
+        """
+        font_obj = self.fonts.get((filename, size, packed))
+        if font_obj is None:
+            if packed:
+                font_obj = self._loadFont(filename, size)
+            else:
+                font_obj = ImageFont.truetype(filename, size)
+            self.fonts[(filename, size, packed)] = font_obj
+        return font_obj
+
+    def getOverlay(self):
+        """Return the render plan compiled from the pack's overlay file.
+        The overlay file is only parsed the first time it is needed.
+
+        """
+        if self.overlay is None:
+            xml_file = self.open(_OVERLAY_FILE)
+            root = parse(xml_file).getroot()
+            xml_file.close()
+            self.overlay = compileOverlay(root, self)
+        return self.overlay
+
+    def getIndex(self):
+        """Return a dictionary mapping each weather code to a tuple of the
+        wallpapers (WallpaperInfo) listed for it in the meta data file.
+        The meta data is only parsed the first time it is needed.
+
+        """
+        if self.index is None:
+            self.index = self._readIndex()
+        return self.index
+
+    def _readIndex(self):
+        meta_data = self.open(_IMAGE_META_FILE)
+        images = parse(meta_data).getroot().findall('image')
+        meta_data.close()
+
+        index = {}
+        for image in images:
+            filename = image.findtext('file')
+
+            # Get the weather codes for the image
+            try:
+                # Remove spaces and split using the "," as a deliminator
+                codes = image.attrib['codes'].replace(' ','').split(',')
+            except KeyError:
+                print "Malformed XML document: missing 'codes' attribute in \"%s\"" % filename
+                continue
+
+            wallpaper = WallpaperInfo(image.findtext('title', ''),
+                image.findtext('author', ''), filename)
+            for code in codes:
+                index.setdefault(code, []).append(wallpaper)
+
+        # Tuples are a little more compact than lists
+        for code in index:
+            index[code] = tuple(index[code])
+
+        return index
+
+
+# The wallpaper pack currently in use
+_CurrentPack = None
+
+def getPack():
+    """Return the wallpaper pack named in the settings, opening it the first
+    time it is used and reloading it whenever the pack file changes.
+
+    """
+    global _CurrentPack
+
+    if _CurrentPack is None or _CurrentPack.path != AppSettings['wallpaper_pack']:
+        if _CurrentPack is not None:
+            _CurrentPack.close()
+        _CurrentPack = WallpaperPack(AppSettings['wallpaper_pack'])
+    else:
+        _CurrentPack.refresh()
+
+    return _CurrentPack
 
 def ExtractFile(filename):
     """Extracts a file from a zip archive and returns the path to the extracted file"""
-    try:
-        zf = zipfile.ZipFile(AppSettings['wallpaper_pack'], "r")
-        
-        # If this zip contains a directory as the first item
-        if zf.namelist()[0][-1:] == '/':
-            zf.extract(zf.namelist()[0] + filename, _TEMP_DIR)
-            return os.path.join(_TEMP_DIR, zf.namelist()[0] + filename)
-        else:
-            zf.extract(filename, _TEMP_DIR)
-            return os.path.join(_TEMP_DIR, filename)
-    except:
-        raise
-        
-    return None
+    return getPack().extract(filename)
 
 def ReadFileInZip(filename, mode):
     """Return a file object to a file within a zip"""
-    try:
-        zf = zipfile.ZipFile(AppSettings['wallpaper_pack'], "r")
-        
-        # If files are contained in a directory
-        folder = os.path.dirname(zf.namelist()[0])
-        
-        if len(folder) != 0:
-            if mode == "r":
-                print os.path.normpath(folder + "/" + filename)
-                fp = zf.open(folder + "/" + filename)
-            else:
-                zf.extract(folder + "/" + filename, _TEMP_DIR)
-                fp = open(os.path.join(_TEMP_DIR, os.path.join(folder, filename)), mode)
-                print "Extracting %s from %s" % (filename, AppSettings['wallpaper_pack'])
-        else:
-            if mode == "r":
-                    fp = zf.open(filename)
-            else:
-                zf.extract(filename, _TEMP_DIR)
-                fp = open(os.path.join(_TEMP_DIR, filename), mode)
-                print "Extracting %s from %s" % (filename, AppSettings['wallpaper_pack'])
-    except:
-        raise
-        
+    pack = getPack()
+
+    if mode == "r":
+        print os.path.normpath(pack.member(filename))
+        fp = pack.open(filename)
+    else:
+        # Read binary files into memory rather than extracting them
+        fp = cStringIO.StringIO(pack.read(filename))
+
     return fp
 
-def getWallpaper(code):
-    """Returns a random wallpaper from the set of wallpapers 
-    matching the given weather code.
+def getWallpaper(code, pack=None):
+    """Returns a random wallpaper (WallpaperInfo) from the set of wallpapers
+    matching the given weather code, from the given pack or the pack named
+    in the settings.
 
     """
-    global AppSettings
-    
-    # Retrieve meta information from XML document
-    meta_data = ReadFileInZip(_IMAGE_META_FILE, "r")
-    images = parse(meta_data).getroot().findall('image')
+    if pack is None:
+        pack = getPack()
 
     # An array of wallpapers matching the current conditions
-    wallpaper = []
+    wallpapers = pack.getIndex().get(code)
 
-    # For each image listed
-    for image in images:
-        # Get the weather codes for the image
-        try:
-            # Remove spaces and split using the "," as a deliminator
-            codes = image.attrib['codes'].replace(' ','').split(',')
-        except KeyError:
-            print "Malformed XML document: missing 'codes' attribute in \"%s\"" % image.find('file').text
-            continue
-
-        # If the current weather matches the image weather
-        if code in codes:
-            wallpaper.append(image)
-                
-            
-    #print "# of matching wallpapers =", len(wallpaper)
-
-    # Add some randomness
-    random.shuffle(wallpaper)
-    
     # If no matches were found
     # try again using the error code
-    if len(wallpaper) == 0:
+    if not wallpapers:
         if code != "3200":
-            wallpaper.append(getWallpaper("3200"))
+            return getWallpaper("3200", pack)
         else:
             print "No error wallpaper defined"
             exit(0)
-    
-    meta_data.close()
-    
-    return wallpaper[0]
 
+    # Add some randomness
+    return random.choice(wallpapers)
+
+
+class RenderCache:
+    """An on-disk cache of rendered wallpapers.
+
+    Each entry is a finished output file named after a hash of everything
+    that went into rendering it. Entries are evicted least recently used
+    first once the total size of the cache exceeds max_size bytes.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def _entry(self, key, output_file):
+        return os.path.join(self.path, key + os.path.splitext(output_file)[1])
+
+    def get(self, key, output_file):
+        """Copy a cached rendering to output_file. Returns False if there is
+        no entry for the key.
+
+        """
+        entry = self._entry(key, output_file)
+        if self.max_size <= 0 or not os.path.exists(entry):
+            return False
+
+        shutil.copyfile(entry, output_file)
+        # Mark the entry as recently used
+        os.utime(entry, None)
+        return True
+
+    def put(self, key, output_file):
+        """Add a freshly rendered output_file to the cache"""
+        if self.max_size <= 0:
+            return
+        shutil.copyfile(output_file, self._entry(key, output_file))
+        self.evict()
+
+    def read(self, key, extension):
+        """Return the contents of the cached rendering with the given file
+        extension, or None if there is none.
+
+        """
+        entry = os.path.join(self.path, key + extension)
+        if self.max_size <= 0:
+            return None
+        try:
+            f = open(entry, "rb")
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            os.utime(entry, None)
+        except (IOError, OSError):
+            # Missing, or evicted while it was being read
+            return None
+        return data
+
+    def write(self, key, extension, data):
+        """Add a rendering held in memory to the cache. Entries are written
+        under a temporary name first, so other threads never read one that
+        is half written.
+
+        """
+        if self.max_size <= 0:
+            return
+        entry = os.path.join(self.path, key + extension)
+        temp = "%s.%d.tmp" % (entry, thread.get_ident())
+        f = open(temp, "wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        try:
+            os.rename(temp, entry)
+        except OSError:
+            # Windows will not rename over an existing file, which another
+            # thread has just rendered anyway
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits
+        within its size limit.
+
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                # Already removed by another thread
+                pass
+            total -= size
+
+
+# The cache of rendered wallpapers
+_RenderCache = None
+
+def getRenderCache():
+    """Return the cache of rendered wallpapers, sized according to the
+    current settings.
+
+    """
+    global _RenderCache
+
+    if _RenderCache is None:
+        _RenderCache = RenderCache(os.path.join(_PROG_WORKING_DIR, _RENDER_CACHE_DIR), 0)
+    _RenderCache.max_size = AppSettings['render_cache_size'] * 1024 * 1024
+
+    return _RenderCache
+
+class ImageCache:
+    """An in-memory cache of decoded images.
+
+    Entries are evicted least recently used first once the memory taken up
+    by the decoded images exceeds max_size bytes. The cache may be shared
+    between threads.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.images = {}
+        self.order = []     # Least recently used first
+        self.lock = threading.RLock()
+
+    def _cost(self, image):
+        return image.size[0] * image.size[1] * len(image.getbands())
+
+    def get(self, key):
+        """Return the cached image for key, or None"""
+        self.lock.acquire()
+        try:
+            image = self.images.get(key)
+            if image is not None:
+                self.order.remove(key)
+                self.order.append(key)
+            return image
+        finally:
+            self.lock.release()
+
+    def put(self, key, image):
+        self.lock.acquire()
+        try:
+            if key in self.images:
+                self.size -= self._cost(self.images[key])
+                self.order.remove(key)
+            self.images[key] = image
+            self.order.append(key)
+            self.size += self._cost(image)
+            self.evict()
+        finally:
+            self.lock.release()
+
+    def evict(self):
+        """Remove the least recently used images until the cache fits
+        within its size limit.
+
+        """
+        self.lock.acquire()
+        try:
+            while self.order and self.size > self.max_size:
+                key = self.order.pop(0)
+                self.size -= self._cost(self.images.pop(key))
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.images = {}
+            self.order = []
+            self.size = 0
+        finally:
+            self.lock.release()
+
+
+# The cache of decoded wallpaper images
+_ImageCache = None
+
+def getImageCache():
+    """Return the cache of decoded wallpaper images, sized according to the
+    current settings.
+
+    """
+    global _ImageCache
+
+    if _ImageCache is None:
+        _ImageCache = ImageCache(0)
+    _ImageCache.max_size = AppSettings['image_cache_size'] * 1024 * 1024
+    _ImageCache.evict()
+
+    return _ImageCache
+
+def getBaseImage(filename, pack=None, size=None):
+    """Return a copy of a wallpaper image from the pack that may be drawn on,
+    scaled to size if it is given. Each image is decoded and scaled once
+    for each size, and then kept in the image cache.
+
+    """
+    if pack is None:
+        pack = getPack()
+    info = pack.getinfo(filename)
+    key = (pack.path, info.filename, info.CRC, size)
+
+    cache = getImageCache()
+    image = cache.get(key)
+    if image is None:
+        image = loadImage(pack, filename, size)
+        cache.put(key, image)
+
+    return image.copy()
+
+def loadImage(pack, filename, size=None):
+    """Decode a wallpaper image from the pack, scaled to size if it is
+    given.
 
-def drawOverlayFromFile(WStatus):
-    """ Draw an overlay on a specified file using the formatting pulled from an 
-    XML document. 
-    
     """
-    
     # Open the image
     try:
-        fp = ReadFileInZip(WStatus['filename'], "rb")
-    except IOError:
-        print "Could not open wallpaper file:\n%s" % WStatus['filename']
+        data = pack.read(filename)
+    except (IOError, KeyError):
+        print "Could not open wallpaper file:\n%s" % filename
         exit(2)
-        
+
+    return decodeImage(data, size)
+
+def decodeImage(data, size=None):
+    """Decode image data, scaled to fill size if it is given.
+
+    The aspect ratio is kept: the image is scaled until it covers size and
+    the middle of it is cropped out. JPEG images are decoded at 1/2, 1/4 or
+    1/8 scale when that still covers size, so the decoder does most of the
+    scaling and the full size image is never held in memory.
+
+    """
+    fp = cStringIO.StringIO(data)
     image = Image.open(fp)
+    if size is not None:
+        cover = getCoverSize(image.size, size)
+        if image.format == 'JPEG' and image.size[0] >= 2 * cover[0] \
+                and image.size[1] >= 2 * cover[1]:
+            image.draft(image.mode, cover)
     image.load() #Make sure PIL has read the data
-    draw = ImageDraw.Draw(image)
-      
-    # Open the XML document
-    xml_file = ReadFileInZip(_OVERLAY_FILE, 'r')
-    root = parse(xml_file).getroot()
-    
+    fp.close()
+
+    if size is None:
+        return image
+    # Draft mode may have rounded the size, so work it out again
+    cover = getCoverSize(image.size, size)
+    if image.size != cover:
+        image = image.resize(cover, Image.ANTIALIAS)
+    if cover != size:
+        left = (cover[0] - size[0]) // 2
+        top = (cover[1] - size[1]) // 2
+        image = image.crop((left, top, left + size[0], top + size[1]))
+        image.load()
+    return image
+
+def getCoverSize(image_size, size):
+    """Return image_size scaled, keeping its aspect ratio, to the smallest
+    size that covers size.
+
+    """
+    scale = max(size[0] / float(image_size[0]), size[1] / float(image_size[1]))
+    return (max(size[0], int(round(image_size[0] * scale))),
+        max(size[1], int(round(image_size[1] * scale))))
+
+def compileTemplate(text, fields):
+    """Split the text of an overlay line into a template tuple that
+    alternates between literal text and the names of fields to substitute.
+
+    """
+    text = '' if text == None else text
+    return tuple(re.split('%%(%s)%%' % '|'.join(fields), text))
+
+def compileOverlay(root, pack):
+    """Compile a parsed overlay.xml into a render plan: a list of
+    OverlayLine, one per line in the document, with fonts loaded,
+    attributes defaulted and text split into templates.
+
+    """
+    plan = []
+    # The previous font file, and whether it was in the pack
     prev_font = None
-    
+
     for font in root:
-        # Font settingsAppSettings['xml_file']
+        # Font settings
         try:
             size = int(font.attrib['size'])
         except KeyError:
@@ -321,26 +906,22 @@ def drawOverlayFromFile(WStatus):
             font_file = font.attrib['file']
         except KeyError:
             if prev_font == None:
-                font_obj = ImageFont.truetype(_DEFAULT_FONT, size)
+                font_obj = pack.getFont(_DEFAULT_FONT, size, False)
             else:
-                font_obj = ImageFont.truetype(prev_font, size)
+                font_obj = pack.getFont(prev_font[0], size, prev_font[1])
         else:
-            # Extract the font file
+            # Load the font file from the pack
             try:
-                filename = ExtractFile(font_file)
+                font_obj = pack.getFont(font_file, size)
             except KeyError:
                 print "There is no item named %s in the pack." % font_file
-                font_obj = ImageFont.truetype(_DEFAULT_FONT, size)
-                prev_font = _DEFAULT_FONT
+                font_obj = pack.getFont(_DEFAULT_FONT, size, False)
+                prev_font = (_DEFAULT_FONT, False)
             else:
-                font_obj = ImageFont.truetype(filename, size)
-                prev_font = filename
+                prev_font = (font_file, True)
         
         # Optional alignment
-        try:
-            alignment = font.attrib['align']
-        except KeyError:
-            alignment = None
+        alignment = font.attrib.get('align')
             
         # Optional border
         try: 
@@ -349,104 +930,360 @@ def drawOverlayFromFile(WStatus):
         except KeyError:
             border = None
             bordercolor = None
-        
-        # Draw the line one-by-one
+
         for line in font:
-            # Get the text between the open and close tags
-            text = '' if line.text == None else line.text
-            
-            # If this is not an error message
-            if WStatus['code'] != _WEATHER_ERROR_CODE and line.tag != 'errorline':
-                # Text replacements
-                text = text.replace('%title%', WStatus['title'])
-                text = text.replace('%author%', WStatus['author'])
-                text = text.replace('%temp%', WStatus['temp'])
-                text = text.replace('%degree%', u'\u00B0')
-                text = text.replace('%unit%', 'C' if AppSettings['metric_units'] else 'F' )
-                text = text.replace('%condition%', WStatus['condition'])
-                text = text.replace('%humidity%', WStatus['humidity'])
-                text = text.replace('%date%', WStatus['date'])
-                text = text.replace('%forecast%', WStatus['forecast'])
-                text = text.replace('%feelslike%', str(WStatus['feels_like']))
-            # If this is an error message
-            elif WStatus['code'] == _WEATHER_ERROR_CODE and line.tag == 'errorline':
-                text = text.replace('%errormsg%', WStatus['errormsg'])
-            # Otherwise, ignore the line
+            error = line.tag == 'errorline'
+            if error:
+                template = compileTemplate(line.text, _ERROR_FIELDS)
             else:
-                continue
+                template = compileTemplate(line.text, _WEATHER_FIELDS)
 
-            # The first X-coordinate is manditory, but afterwards, it can be
-            # left off. If it is not specified, the previous value of x will
-            # be used.
-            try:
-                x = int(line.attrib['x'])
-            except KeyError:
-                try:
-                    x = x_prev # use the previously defined x value
-                except NameError:
-                    print "overlay.xml: The first line tag must have x and y coordinates."
-                    exit(2)
-            else:
-                # A negative indicates distance from right edge
-                if x < 0: 
-                    x = x + image.size[0]   # Add the width of the image
-                x_prev = x
-
-            # Align the text right if necessary
-            if alignment == "right":
-                line_width = draw.textsize(text, font=font_obj)[0]
-                x = x - line_width
-                
-            # The first Y-coordinate is manditory, but afterwards, it can be
-            # left off. If it is not specified, the previous value of y will
-            # be incremented by the font's line height and used."""
-            try:
-                y =  int(line.attrib['y'])
-            except:
-                # increment y by the line-hight
-                y = y + draw.textsize(text, font=font_obj)[1]
-            else:
-                if y < 0: # negative indicates distance from bottom
-                    y = y + image.size[1]
-                    
-            print "x =", x, ", y =", y, ", text =", text
-                
-            # Draw border if one exists
-            if border is not None:
-                for i in range(0, border):
-                    # Thin border
-                    if i == 0:
-                        draw.text((x-1, y), text, font=font_obj, fill=bordercolor)
-                        draw.text((x+1, y), text, font=font_obj, fill=bordercolor)
-                        draw.text((x, y-1), text, font=font_obj, fill=bordercolor)
-                        draw.text((x, y+1), text, font=font_obj, fill=bordercolor)
-                    else:
-                        # Thick border
-                        draw.text((x-i, y-i), text, font=font_obj, fill=bordercolor)
-                        draw.text((x+i, y-i), text, font=font_obj, fill=bordercolor)
-                        draw.text((x-i, y+i), text, font=font_obj, fill=bordercolor)
-                        draw.text((x+i, y+i), text, font=font_obj, fill=bordercolor)
-            
-            # Draw the overlay
-            draw.text((x, y), text, font=font_obj, fill=fill_color)
-    
-    # Load the settings
-    output_file = os.path.join(_PROG_WORKING_DIR, _OUTPUT_FILE)
+            # Coordinates that are left off are worked out when drawing
+            x = line.attrib.get('x')
+            if x is not None:
+                x = int(x)
+            y = line.attrib.get('y')
+            if y is not None:
+                y = int(y)
+
+            plan.append(OverlayLine(error, template, x, y, font_obj,
+                fill_color, alignment, border, bordercolor))
+
+    return plan
+
+def getOverlayFields(WStatus):
+    """Return the values substituted into the overlay text for the given
+    weather status.
+
+    """
+    if WStatus['code'] == _WEATHER_ERROR_CODE:
+        return {'errormsg': WStatus['errormsg']}
+
+    return {
+        'title': WStatus['title'],
+        'author': WStatus['author'],
+        'temp': WStatus['temp'],
+        'degree': u'\u00B0',
+        'unit': WStatus['temp_unit'],
+        'condition': WStatus['condition'],
+        'humidity': WStatus['humidity'],
+        'date': WStatus['date'],
+        'forecast': WStatus['forecast'],
+        'feelslike': str(WStatus['feels_like']),
+    }
+
+def getOverlayTexts(plan, WStatus):
+    """Return the text of each line in the render plan with the weather
+    information substituted in, or None for lines that should not be drawn.
+
+    """
+    fields = getOverlayFields(WStatus)
+    error = WStatus['code'] == _WEATHER_ERROR_CODE
+
+    texts = []
+    for line in plan:
+        # Error lines are only drawn for errors, all others only when
+        # there is no error
+        if line.error != error:
+            texts.append(None)
+            continue
+
+        parts = list(line.template)
+        for i in range(1, len(parts), 2):
+            parts[i] = fields[parts[i]]
+        texts.append(''.join(parts))
+
+    return texts
+
+def getOutputEncoder(settings=None):
+    """Return the OutputEncoder for the output settings, taken from the
+    global settings if none are given.
+
+    """
+    if settings is None:
+        settings = AppSettings
+    (format, extension) = _OUTPUT_FORMATS[settings['output_format']]
+
+    options = {}
+    if format == "JPEG":
+        options['quality'] = settings['output_quality']
+        options['subsampling'] = _JPEG_SUBSAMPLING[settings['output_subsampling']]
+        if settings['output_optimize']:
+            options['optimize'] = True
+        if settings['output_progressive']:
+            options['progressive'] = True
+    elif format == "PNG":
+        options['compress_level'] = settings['output_compress_level']
+        if settings['output_optimize']:
+            options['optimize'] = True
+
+    return OutputEncoder(format, extension, options)
+
+def getOutputFile(encoder=None):
+    """Return the path the wallpaper is saved to with the given encoder,
+    or the one from the settings.
+
+    """
+    if encoder is None:
+        encoder = getOutputEncoder()
+    return os.path.join(_PROG_WORKING_DIR, _OUTPUT_NAME + encoder.extension)
+
+def getRenderKey(WStatus, texts, pack=None, size=None, encoder=None):
+    """Return a key identifying a rendered wallpaper. It is a hash of the
+    source image, the overlay definition, the text drawn, the size the image
+    is scaled to and the output format and its options.
+
+    """
+    if pack is None:
+        pack = getPack()
+    if encoder is None:
+        encoder = getOutputEncoder()
+    key = hashlib.sha1()
+    for filename in (WStatus['filename'], _OVERLAY_FILE):
+        info = pack.getinfo(filename)
+        key.update("%s:%08x:%d\n" % (info.filename, info.CRC, info.file_size))
+    key.update(repr(texts))
+    if size is not None:
+        key.update("%dx%d" % size)
+    key.update(encoder.extension)
+    key.update(repr(sorted(encoder.options.items())))
+    return key.hexdigest()
+
+def drawOverlayFromFile(WStatus):
+    """ Draw an overlay on a specified file using the formatting pulled from an 
+    XML document. 
     
+    """
+    encoder = getOutputEncoder()
+    output_file = getOutputFile(encoder)
+
+    plan = getPack().getOverlay()
+
+    # The text of each line is all that changes between updates, so if this
+    # exact text has been drawn on this image before, reuse the result
+    texts = getOverlayTexts(plan, WStatus)
+    size = (AppSettings['screen_width'], AppSettings['screen_height'])
+    cache = getRenderCache()
+    key = getRenderKey(WStatus, texts, size=size, encoder=encoder)
+    if cache.get(key, output_file):
+        print "Using cached wallpaper %s" % key
+        return
+
+    # Draw on the image scaled to the screen, which is quicker to draw on
+    # and to save than a larger original. Only the lines that differ from
+    # the last wallpaper drawn are drawn again.
+    pack = getPack()
+    info = pack.getinfo(WStatus['filename'])
+    base_key = (pack.path, info.filename, info.CRC, size)
+    image = getOverlayFrame().render(base_key, plan, texts,
+        lambda: getBaseImage(WStatus['filename'], pack, size))
+
     # Save the new file
     if os.path.exists(output_file):
         os.remove(output_file)
-    # XP does not support image types other than BMP
-    if platform.release() == "XP":
-        image.save(output_file, "BMP", quality=100)
-    else:
-        image.save(output_file, "JPEG", quality=100)
-    
-    
-    # Close and delete temporary file
-    filename = fp.name
-    fp.close()
-    os.remove(filename)
+    image.save(output_file, encoder.format, **encoder.options)
+    cache.put(key, output_file)
+
+def renderOverlay(image, plan, texts):
+    """Draw the text of each line of the render plan onto image"""
+    draw = ImageDraw.Draw(image)
+    positions = layoutOverlay(draw, image.size, plan, texts)
+    for line, text, position in zip(plan, texts, positions):
+        if text is not None:
+            drawLine(draw, line, text, position)
+
+def layoutOverlay(draw, size, plan, texts):
+    """Return where each line of the render plan is drawn on an image of the
+    given size, as a (left, top, width, height) tuple, or None for lines
+    that are not drawn.
+
+    """
+    x = None
+    y = None
+    positions = []
+
+    for line, text in zip(plan, texts):
+        if text is None:
+            positions.append(None)
+            continue
+
+        (width, height) = draw.textsize(text, font=line.font)
+
+        # The first X-coordinate is manditory, but afterwards, it can be
+        # left off. If it is not specified, the previous value of x will
+        # be used.
+        if line.x is not None:
+            x = line.x
+            # A negative indicates distance from right edge
+            if x < 0: 
+                x = x + size[0]   # Add the width of the image
+        elif x is None:
+            print "overlay.xml: The first line tag must have x and y coordinates."
+            exit(2)
+
+        # Align the text right if necessary
+        left = x
+        if line.align == "right":
+            left = x - width
+            
+        # The first Y-coordinate is manditory, but afterwards, it can be
+        # left off. If it is not specified, the previous value of y will
+        # be incremented by the font's line height and used.
+        if line.y is not None:
+            y = line.y
+            if y < 0: # negative indicates distance from bottom
+                y = y + size[1]
+        elif y is None:
+            print "overlay.xml: The first line tag must have x and y coordinates."
+            exit(2)
+        else:
+            # increment y by the line-hight
+            y = y + height
+
+        positions.append((left, y, width, height))
+
+    return positions
+
+def drawLine(draw, line, text, position):
+    """Draw one line of the render plan at the position given by
+    layoutOverlay.
+
+    """
+    (left, y) = position[:2]
+    font_obj = line.font
+
+    if not line.border:
+        draw.text((left, y), text, font=font_obj, fill=line.fill)
+        return
+
+    # Draw the text once into a mask and widen it with a max filter for the
+    # border, rather than drawing the text again for each pixel of border.
+    # The border reaches as far as the text drawn at offsets used to.
+    reach = max(line.border - 1, 1)
+    (width, height) = position[2:]
+    pad = reach + height // 4 + 1
+    mask = Image.new("L", (width + 2 * pad, height + 2 * pad), 0)
+    ImageDraw.Draw(mask).text((pad, pad), text, font=font_obj, fill=255)
+    border_mask = mask.filter(ImageFilter.MaxFilter(2 * reach + 1))
+
+    draw.bitmap((left - pad, y - pad), border_mask, fill=line.bordercolor)
+    draw.bitmap((left - pad, y - pad), mask, fill=line.fill)
+
+def getLineBox(line, position, size):
+    """Return the box (left, upper, right, lower) that drawing a line at
+    position may touch on an image of the given size, or None if it is
+    entirely off the image. The box is padded for the border and for glyphs
+    that reach outside the size PIL reports for the text.
+
+    """
+    if position is None:
+        return None
+
+    (left, top, width, height) = position
+    pad = (line.border or 0) + height // 4 + 1
+    box = (max(left - pad, 0), max(top - pad, 0),
+        min(left + width + pad, size[0]), min(top + height + pad, size[1]))
+    if box[0] >= box[2] or box[1] >= box[3]:
+        return None
+    return box
+
+def _boxesOverlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+def _mergeBoxes(boxes):
+    """Return boxes with any that overlap replaced by the box around them"""
+    merged = []
+    for box in boxes:
+        i = 0
+        while i < len(merged):
+            if _boxesOverlap(box, merged[i]):
+                other = merged.pop(i)
+                box = (min(box[0], other[0]), min(box[1], other[1]),
+                    max(box[2], other[2]), max(box[3], other[3]))
+                i = 0
+            else:
+                i += 1
+        merged.append(box)
+    return merged
+
+class OverlayFrame:
+    """The last wallpaper drawn, kept so that an update only redraws the
+    parts of the overlay whose text changed.
+
+    The base image is kept alongside the frame drawn on it. An update finds
+    the boxes around the lines whose text or position changed, copies each
+    one from the base image, draws every line that reaches into it and
+    pastes it into the frame. A new temperature then touches a few kilobytes
+    of the image rather than all of it.
+    """
+
+    def __init__(self):
+        self.key = None
+        self.plan = None
+        self.base = None
+        self.image = None
+        self.texts = []
+        self.boxes = []
+
+    def render(self, key, plan, texts, getBase):
+        """Return the base image identified by key with the texts of the
+        render plan drawn on it. getBase is only called, for a copy of the
+        base image, when key or plan differ from the last call.
+
+        The image returned is changed by later calls, so it must not be
+        drawn on.
+        """
+        if key != self.key or plan is not self.plan:
+            self.key = key
+            self.plan = plan
+            self.base = getBase()
+            self.image = self.base.copy()
+            self.texts = None
+
+        draw = ImageDraw.Draw(self.image)
+        size = self.image.size
+        positions = layoutOverlay(draw, size, plan, texts)
+        boxes = [getLineBox(line, position, size)
+            for line, position in zip(plan, positions)]
+
+        if self.texts is None:
+            for line, text, position in zip(plan, texts, positions):
+                if text is not None:
+                    drawLine(draw, line, text, position)
+        else:
+            dirty = []
+            for i in range(len(plan)):
+                if texts[i] != self.texts[i] or boxes[i] != self.boxes[i]:
+                    dirty.extend([box for box in (self.boxes[i], boxes[i])
+                        if box is not None])
+
+            # Redraw each region from the base image up, so that lines
+            # overlapping it are drawn in the same order as before
+            for region in _mergeBoxes(dirty):
+                patch = self.base.crop(region)
+                patch_draw = ImageDraw.Draw(patch)
+                for line, text, position, box in zip(plan, texts, positions,
+                        boxes):
+                    if box is not None and _boxesOverlap(box, region):
+                        (left, top, width, height) = position
+                        drawLine(patch_draw, line, text, (left - region[0],
+                            top - region[1], width, height))
+                self.image.paste(patch, region[:2])
+
+        self.texts = list(texts)
+        self.boxes = boxes
+        return self.image
+
+# The last wallpaper drawn by drawOverlayFromFile
+_OverlayFrame = None
+
+def getOverlayFrame():
+    """Return the last wallpaper drawn, creating it the first time"""
+    global _OverlayFrame
+
+    if _OverlayFrame is None:
+        _OverlayFrame = OverlayFrame()
+    return _OverlayFrame
 
 
 # Create a new image that has the current weather conditions overlayed on the background
@@ -500,8 +1337,8 @@ def updateDesktop():
         # http://mail.python.org/pipermail/python-list/2005-July/330379.html
         #shutil.copyfile(os.path.join(images_dir, wallpaper[0].find('file').text), wallpaperfile)
         # Refresh the desktop
-        SPI_SETDESKWALLPAPER = 20 # According to http://support.microsoft.com/default.aspx?scid=97142
-        ctypes.windll.user32.SystemParametersInfoA(SPI_SETDESKWALLPAPER, 0, os.path.join(_PROG_WORKING_DIR, _OUTPUT_FILE), 0)
+        SPI_SETDESKWALLPAPER = 20 # According to http://support.microsoft.com/default.aspx?scid=97142
+        ctypes.windll.user32.SystemParametersInfoA(SPI_SETDESKWALLPAPER, 0, getOutputFile(), 0)
         #cs = ctypes.c_buffer(output_file)
         #ctypes.windll.user32.SystemParametersInfoA(win32con.SPI_SETDESKWALLPAPER,0,output_file,0)
         #win32gui.SystemParametersInfo (win32con.SPI_SETDESKWALLPAPER, bmp_path, win32con.SPIF_SENDCHANGE)
@@ -517,22 +1354,22 @@ def updateDesktop():
         end tell
         END"""
 
-        subprocess.Popen(SCRIPT % os.path.join(_PROG_WORKING_DIR, _OUTPUT_FILE), shell=True)
+        subprocess.Popen(SCRIPT % getOutputFile(), shell=True)
     # Linux Gnome
     elif detectOS() == 'gnome':
         # http://www.tuxradar.com/content/code-project-use-weather-wallpapers
-        cmd = string.join(["gconftool-2 -s /desktop/gnome/background/picture_filename -t string \"",os.path.join(_PROG_WORKING_DIR, _OUTPUT_FILE),"\""],'')
+        cmd = string.join(["gconftool-2 -s /desktop/gnome/background/picture_filename -t string \"",getOutputFile(),"\""],'')
         os.system(cmd)
     # Linus KDE
     elif detectOS() == 'kde': 
             if os.getenv('KDE_SESSION_VERSION') == '':
                 # KDE 3.5
-                cmd = "dcop kdesktop KBackgroundIface setWallpaper %s 6" % os.path.join(_PROG_WORKING_DIR, _OUTPUT_FILE)
+                cmd = "dcop kdesktop KBackgroundIface setWallpaper %s 6" % getOutputFile()
                 os.system(cmd)
             else:
                 # KDE 4
                 print "KDE4"
-                cmd = "kwriteconfig --file plasma-appletsrc --group Containments --group 1 --group Wallpaper --group image --key wallpaper %s" % os.path.join(_PROG_WORKING_DIR, _OUTPUT_FILE)
+                cmd = "kwriteconfig --file plasma-appletsrc --group Containments --group 1 --group Wallpaper --group image --key wallpaper %s" % getOutputFile()
                 os.system(cmd)
     else:
         # Attempt to create a symbolic link from the old to the new wallpaper
@@ -540,7 +1377,7 @@ def updateDesktop():
             os.remove(AppSettings['symlink'])
         except OSError:
             pass
-        os.symlink(os.path.join(_PROG_WORKING_DIR, _OUTPUT_FILE), os.path.join(_PROG_WORKING_DIR, 'symlink'))
+        os.symlink(getOutputFile(), os.path.join(_PROG_WORKING_DIR, 'symlink'))
         
 
 def updateWallpaper(WStatus):
@@ -557,8 +1394,17 @@ def updateWallpaper(WStatus):
         #drawOverlay(os.path.join(AppSettings['images_dir'], WStatus['filename']), text)
         drawOverlayFromFile(WStatus)
     else:
-        # Don't draw overlay, just copy the file
-        shutil.copyfile(os.path.join(AppSettings['images_dir'], WStatus['filename']), os.path.join(_PROG_WORKING_DIR, _OUTPUT_FILE))
+        # Don't draw overlay, just copy the file if it is already in the
+        # output format
+        encoder = getOutputEncoder()
+        data = getPack().read(WStatus['filename'])
+        if Image.open(cStringIO.StringIO(data)).format == encoder.format:
+            output = open(getOutputFile(encoder), "wb")
+            output.write(data)
+            output.close()
+        else:
+            image = decodeImage(data)
+            image.save(getOutputFile(encoder), encoder.format, **encoder.options)
 
     # Force the desktop to update the wallpaper
     updateDesktop()    
@@ -589,170 +1435,402 @@ def ReadCredits():
         if index != -1:
             print line[index+4:].strip()
     
-def main():
-    """ Main function of Weather Wallpaper """
-    global AppSettings
-    
-    # Weather Status dictionary
-    # Contains all the weather information that gets passed between functions
-    # These may be referenced from overlay.xml by placing "%" around the name,
-    # as in; "%temp%" or "%author%".
-    WStatus = {
-        'title': '',
-        'author': '',
-        'filename': '',
-        'code': '',
-        'temp': '',
-        'feels_like': '',
-        'condition': '',
-        'date': '',
-        'humidity': '',
-        'wind_chill': '',
-        'forecast': '',
-        'temp_unit': '',
-    }    
-
-    # Previous weather conditions haven't been set yet
-    previous_weather_code = -1
-    previous_weather_date = ''
-
-    # Initialize last update to one week ago to make sure we update on start
-    lastUpdate = datetime.now() - timedelta(days = 7)
-
-    #Start main loop
-    while(True):
-        # Get the current time
-        now = datetime.now()
-        # Compare current time to last update timestaWStatusmp
-        # This is better than using wait() because it forces a refresh immidiately
-        # after resuming from suspend/hibernate
-        if (now - lastUpdate) > timedelta(minutes = AppSettings['refresh_delay']):
-            # update the timestamp
-            lastUpdate = now
-            
-            # Retrive current weather from yahoo weather
-            # The complete documentation for the Yahoo Weather RSS feed
-            # can be found at http://developer.yahoo.com/weather/
-            weather = None
+class _Inotify(asyncore.file_dispatcher):
+    """Calls changed() when a file in one of the watched directories is
+    written, replaced or removed. Only available on Linux.
+    """
+
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    _MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+        | IN_CREATE | IN_DELETE)
+
+    # struct inotify_event without the name that follows it
+    _EVENT = struct.Struct('iIII')
+
+    _libc = None
+
+    @classmethod
+    def create(cls, changed):
+        """Return a new _Inotify, or None if inotify is not available"""
+        if not sys.platform.startswith('linux'):
+            return None
+        if cls._libc is None:
             try:
-                weather = pywapi.get_weather_from_yahoo(AppSettings['location_id'], 'metric' if AppSettings['metric_units'] else '')
-            except urllib2.URLError:
-                print "Could Not Connect"
-                # Reset weather date so that the error image is replace when 
-                # the connection is re-established
-                previous_weather_date = ''
-                # Draw status on image
-                if AppSettings['overlay_enabled']:
-                    # Create error object
-                    WError = {
-                        'code': _WEATHER_ERROR_CODE,
-                        'errormsg': 'Could Not Connect',
-                        'filename': None
-                    }
-                    wallpaper = getWallpaper(WError['code'])
-                    WError['filename'] = wallpaper.find('file').text
-                    print WStatus['filename']
-                    drawOverlayFromFile(WError)
-                    #drawOverlay(os.path.join(AppSettings['images_dir'], wallpaper.find('file').text), text)
-                    updateDesktop()
-                # Retry every 5 seconds
-                while weather is None:
-                    time.sleep(5)
-                    try: 
-                        weather = pywapi.get_weather_from_yahoo(AppSettings['location_id'], 'metric' if AppSettings['metric_units'] else '')
-                    except urllib2.URLError:
-                        pass
-            
-            # Retrieve the date/time this weather info was issued
-            WStatus['date'] = weather['condition']['date']
-            
-            # Update the wallpaper only when newer data is available
-            if previous_weather_date != WStatus['date']:
-                previous_weather_date = WStatus['date']
-                
-                # Retrieve the new weather information
-                WStatus['code'] = weather['condition']['code']
-                WStatus['temp'] = weather['condition']['temp']
-                WStatus['condition'] = weather['condition']['text']
-                WStatus['humidity'] = weather['atmosphere']['humidity']
-                WStatus['wind_chill'] = weather['wind']['chill']
-                WStatus['forecast'] = weather['forecasts'][0]['text']
-                WStatus['temp_unit'] = weather['units']['temperature']
-                
-                # Feels like temperature
-                if (WStatus['temp_unit'] == 'F' and int(WStatus['temp']) > 80) \
-                  or (WStatus['temp_unit'] == 'C' and int(WStatus['temp']) > 27):
-                    WStatus['feels_like'] = getHeatIndex(WStatus['temp'], WStatus['humidity'])     
-                elif (WStatus['temp_unit'] == 'F' and int(WStatus['temp']) < 50) \
-                  or (WStatus['temp_unit'] == 'C' and int(WStatus['temp']) < 10):
-                    WStatus['feels_like'] = WStatus['wind_chill']
-                else:
-                    WStatus['feels_like'] = WStatus['temp']
-
-                print WStatus['date']
-                print 'Weather Code:',  WStatus['code'], "(%s)" %  WStatus['condition']
-                print 'Current temperature: %s (feels like %s)' % (WStatus['temp'],  WStatus['feels_like'])
-            
-                # Force a change the weather code
-                if AppSettings['use_feels_like']:
-                    if int(WStatus['feels_like']) >= AppSettings['hot_threshold']:
-                        WStatus['code'] = '36' # HOT!
-                    elif int(WStatus['feels_like']) <= AppSettings['cold_threshold']:
-                        WStatus['code'] = '25' # COLD!
-                else:
-                    if int(WStatus['temp']) >= AppSettings['hot_threshold']:
-                        WStatus['code'] = '36' # HOT!
-                    elif int(WStatus['temp']) <= AppSettings['cold_threshold']:
-                        WStatus['code'] = '25' # COLD!
-                        
-                
-                # Only update the image if the condition has changed
-                if(int(WStatus['code']) != int(previous_weather_code)):
-                    print "Select a new wallpaper (Conditions changed from %s to %s)"%(
-                        previous_weather_code, WStatus['code'])
-                
-                    # Bring the variable up to date
-                    previous_weather_code = WStatus['code']
-                    
-                    # Get a random wallpaper matching the current condition
-                    wallpaper = getWallpaper(WStatus['code'])
-
-                    # Get the title and author of the wallpaper
-                    try:
-                        WStatus['title'] = wallpaper.find('title').text
-                    except (KeyError, AttributeError):
-                        WStatus['title'] = ''
-                        
-                    try:
-                        WStatus['author'] = wallpaper.find('author').text
-                    except (KeyError, AttributeError):
-                        WStatus['author'] = ''
-                    
-                    WStatus['filename'] = wallpaper.find('file').text
-                
-                # Does the following as necessary:
-                # Write conditions file, draw overlay, copy image file, call updateDesktop()
-                updateWallpaper(WStatus)
-            
-        # Short delay, this is the minimum "refresh rate"
-        time.sleep(10) # Ten seconds
-        
-        # Update settings
-        # This allows live updating without restarts
+                cls._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                cls._libc.inotify_init
+            except (OSError, AttributeError):
+                return None
+        fd = cls._libc.inotify_init()
+        if fd < 0:
+            return None
+        try:
+            return cls(fd, changed)
+        finally:
+            # The dispatcher keeps its own copy of the descriptor
+            os.close(fd)
+
+    def __init__(self, fd, changed):
+        asyncore.file_dispatcher.__init__(self, fd)
+        self.changed = changed
+        self.dirs = {}
+        self.names = set()
+
+    def watch(self, paths):
+        """Watch the directories containing paths, reporting changes to
+        those files only.
+
+        """
+        self.names = set([os.path.basename(path) for path in paths])
+        for path in paths:
+            directory = os.path.dirname(os.path.abspath(path))
+            if directory in self.dirs.values():
+                continue
+            wd = self._libc.inotify_add_watch(self._fileno, directory, self._MASK)
+            if wd >= 0:
+                self.dirs[wd] = directory
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        data = self.recv(4096)
+        offset = 0
+        while offset + self._EVENT.size <= len(data):
+            (wd, mask, cookie, length) = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if name in self.names:
+                self.changed()
+
+
+class FileWatcher:
+    """Calls changed(path) when one of the watched files has been written,
+    replaced or removed.
+
+    Files are compared by modification time and size. inotify is used to
+    tell when to compare them where it is available; otherwise they are
+    compared every _SETTINGS_CHECK_INTERVAL seconds.
+    """
+
+    def __init__(self, scheduler, changed):
+        self.scheduler = scheduler
+        self.changed = changed
+        self.stats = {}
+        self.inotify = _Inotify.create(self._notified)
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def watch(self, paths):
+        """Watch the files at paths instead of those watched before"""
+        stats = {}
+        for path in paths:
+            stats[path] = self.stats.get(path, self._stat(path))
+        self.stats = stats
+
+        if self.inotify is not None:
+            self.inotify.watch(paths)
+        else:
+            self.scheduler.schedule('watch', _SETTINGS_CHECK_INTERVAL, self.check)
+
+    def _notified(self):
+        self.scheduler.schedule('watch', _WATCH_DELAY, self.check)
+
+    def check(self):
+        """Report the files that have changed since they were last checked"""
+        if self.inotify is None:
+            self.scheduler.schedule('watch', _SETTINGS_CHECK_INTERVAL, self.check)
+
+        for path in self.stats.keys():
+            stat = self._stat(path)
+            if stat != self.stats.get(path):
+                self.stats[path] = stat
+                self.changed(path)
+
+
+class Scheduler:
+    """Runs callbacks when they fall due, sleeping in between.
+
+    Events are kept in a heap ordered by the wall-clock time they are due.
+    While asynchronous weather fetches are in progress the asyncore loop is
+    run instead of sleeping, so their callbacks run as soon as the data
+    arrives. Sleeps are capped at _MAX_SLEEP seconds, and if the wall clock
+    moves by more than expected (after resuming from suspend or when the
+    clock is set) clockJumped is called.
+    """
+
+    def __init__(self, clockJumped):
+        self.clockJumped = clockJumped
+        self.events = []
+        self.pending = {}
+        self.count = 0
+
+    def schedule(self, name, delay, callback):
+        """Run callback in delay seconds, replacing any event of the same
+        name that has not run yet.
+
+        """
+        self.cancel(name)
+        self.count += 1
+        event = [time.time() + delay, self.count, name, callback]
+        heapq.heappush(self.events, event)
+        self.pending[name] = event
+
+    def cancel(self, name):
+        event = self.pending.pop(name, None)
+        if event is not None:
+            # Left in the heap, and skipped when it comes up
+            event[3] = None
+
+    def run(self):
+        """Run events as they fall due, forever"""
+        while True:
+            now = time.time()
+            while self.events and self.events[0][0] <= now:
+                (due, count, name, callback) = heapq.heappop(self.events)
+                if callback is not None:
+                    del self.pending[name]
+                    callback()
+            while self.events and self.events[0][3] is None:
+                heapq.heappop(self.events)
+
+            wait = _MAX_SLEEP
+            if self.events:
+                wait = min(max(self.events[0][0] - time.time(), 0), wait)
+            if [d for d in asyncore.socket_map.values()
+                    if isinstance(d, pywapi.AsyncFetch)]:
+                wait = min(wait, _FETCH_POLL)
+            before = time.time()
+            if asyncore.socket_map:
+                asyncore.loop(wait, count=1)
+            else:
+                time.sleep(wait)
+            elapsed = time.time() - before
+
+            if elapsed < 0 or elapsed > wait + _CLOCK_JUMP:
+                print "Clock jumped by %d seconds" % (elapsed - wait)
+                self.clockJumped()
+
+
+class WeatherUpdater:
+    """Fetches the weather and updates the wallpaper when it changes"""
+
+    def __init__(self):
+        self.scheduler = Scheduler(self.clockJumped)
+        self.watcher = FileWatcher(self.scheduler, self.fileChanged)
+        self.fetch = None
+        # The last weather report received
+        self.weather = None
+
+        # Weather Status dictionary
+        # Contains all the weather information that gets passed between functions
+        # These may be referenced from overlay.xml by placing "%" around the name,
+        # as in; "%temp%" or "%author%".
+        self.WStatus = {
+            'title': '',
+            'author': '',
+            'filename': '',
+            'code': '',
+            'temp': '',
+            'feels_like': '',
+            'condition': '',
+            'date': '',
+            'humidity': '',
+            'wind_chill': '',
+            'forecast': '',
+            'temp_unit': '',
+        }
+
+        # Previous weather conditions haven't been set yet
+        self.previous_weather_code = -1
+        self.previous_weather_date = ''
+        # Whether the last attempt to fetch the weather failed
+        self.failed = False
+
+    def run(self):
+        self.scheduler.schedule('weather', 0, self.fetchWeather)
+        self.watchFiles()
+        self.scheduler.run()
+
+    def watchFiles(self):
+        self.watcher.watch([
+            os.path.join(_PROG_WORKING_DIR, _PROG_SETTINGS_FILE),
+            AppSettings['wallpaper_pack'],
+        ])
+
+    def fetchWeather(self):
+        """Start fetching the current weather from yahoo weather"""
+        # The complete documentation for the Yahoo Weather RSS feed
+        # can be found at http://developer.yahoo.com/weather/
+        if self.fetch is not None:
+            self.fetch.cancel()
+            self.fetch = None
+        fetch = pywapi.get_weather_from_yahoo_async(self.weatherReceived,
+            AppSettings['location_id'], 'metric' if AppSettings['metric_units'] else '')
+        # The callback has already run if the feed was cached
+        if not fetch.done:
+            self.fetch = fetch
+
+    def weatherReceived(self, weather, error):
+        self.fetch = None
+        if error is not None:
+            if not isinstance(error, (urllib2.URLError, socket.timeout)):
+                raise error
+            self.connectionFailed()
+            # Retry every 5 seconds
+            self.scheduler.schedule('weather', _RETRY_DELAY, self.fetchWeather)
+            return
+
+        self.failed = False
+        self.weather = weather
+        self.scheduler.schedule('weather', AppSettings['refresh_delay'] * 60, self.fetchWeather)
+        self.applyWeather(weather)
+
+    def connectionFailed(self):
+        """Show the error wallpaper the first time a fetch fails"""
+        if self.failed:
+            return
+        self.failed = True
+
+        print "Could Not Connect"
+        # Reset weather date so that the error image is replace when
+        # the connection is re-established
+        self.previous_weather_date = ''
+        # Draw status on image
+        if AppSettings['overlay_enabled']:
+            # Create error object
+            WError = {
+                'code': _WEATHER_ERROR_CODE,
+                'errormsg': 'Could Not Connect',
+                'filename': None
+            }
+            wallpaper = getWallpaper(WError['code'])
+            WError['filename'] = wallpaper.file
+            print self.WStatus['filename']
+            drawOverlayFromFile(WError)
+            updateDesktop()
+
+    def applyWeather(self, weather):
+        """Update the wallpaper if the weather report is newer than the
+        last one.
+
+        """
+        WStatus = self.WStatus
+
+        # Retrieve the date/time this weather info was issued
+        WStatus['date'] = weather['condition']['date']
+
+        # Update the wallpaper only when newer data is available
+        if self.previous_weather_date == WStatus['date']:
+            return
+        self.previous_weather_date = WStatus['date']
+
+        # Retrieve the new weather information
+        setWeatherStatus(WStatus, weather, AppSettings)
+
+        print WStatus['date']
+        print 'Weather Code:',  WStatus['code'], "(%s)" %  WStatus['condition']
+        print 'Current temperature: %s (feels like %s)' % (WStatus['temp'],  WStatus['feels_like'])
+
+        # Only update the image if the condition has changed
+        if(int(WStatus['code']) != int(self.previous_weather_code)):
+            print "Select a new wallpaper (Conditions changed from %s to %s)"%(
+                self.previous_weather_code, WStatus['code'])
+
+            # Bring the variable up to date
+            self.previous_weather_code = WStatus['code']
+
+            # Get a random wallpaper matching the current condition
+            wallpaper = getWallpaper(WStatus['code'])
+
+            # Get the title and author of the wallpaper
+            WStatus['title'] = wallpaper.title
+            WStatus['author'] = wallpaper.author
+            WStatus['filename'] = wallpaper.file
+
+        # Does the following as necessary:
+        # Write conditions file, draw overlay, copy image file, call updateDesktop()
+        updateWallpaper(WStatus)
+
+    def fileChanged(self, path):
+        if path == AppSettings['wallpaper_pack']:
+            print "Change to wallpaper pack detected"
+            # The pack is reloaded the next time it is used
+            self.selectWallpaper()
+        else:
+            self.reloadSettings()
+
+    def reloadSettings(self):
+        """Reload the settings file, and bring up to date whatever depends
+        on the settings that changed. This allows live updating without
+        restarts.
+
+        """
+        global AppSettings
+
         AppSettingsNew = loadSettings()
-        # If settings have changed since the last time we checked
-        if AppSettings != AppSettingsNew:
-            print "Change to settings file detected"
-            
-            
-            # Update the settings
-            AppSettings = AppSettingsNew
-            
-            # Force a full refresh
-            updateWallpaper(WStatus)
-            previous_weather_date = ''
-            lastUpdate = datetime.now() - timedelta(days = 7)
-        
+        changed = set([key for key in AppSettingsNew
+            if AppSettingsNew[key] != AppSettings.get(key)])
+        if not changed:
+            return
+        print "Change to settings file detected"
+
+        # Update the settings
+        AppSettings = AppSettingsNew
+
+        if 'wallpaper_pack' in changed:
+            self.watchFiles()
+
+        if changed.intersection(_FETCH_SETTINGS):
+            if changed.intersection(('location_id', 'metric_units')):
+                self.previous_weather_date = ''
+            self.scheduler.schedule('weather', 0, self.fetchWeather)
+        if self.weather is None:
+            # Nothing has been drawn yet
+            return
+        if changed.intersection(_SELECT_SETTINGS):
+            self.selectWallpaper()
+        elif changed.intersection(_RENDER_SETTINGS):
+            updateWallpaper(self.WStatus)
+
+    def selectWallpaper(self):
+        """Choose the wallpaper for the last weather report again"""
+        if self.weather is None:
+            return
+        self.previous_weather_code = -1
+        self.previous_weather_date = ''
+        self.applyWeather(self.weather)
+
+    def clockJumped(self):
+        """Refresh immediately after resuming from suspend/hibernate, and
+        re-time events after the clock has been set.
+
+        """
+        if self.fetch is None:
+            self.scheduler.schedule('weather', 0, self.fetchWeather)
+        self.scheduler.schedule('watch', 0, self.watcher.check)
+
+
+def main():
+    """ Main function of Weather Wallpaper """
+
+    # Keep the weather feed on disk so an unchanged feed is not downloaded
+    # again on every refresh
+    pywapi.set_http_cache(pywapi.HTTPCache(
+        os.path.join(_PROG_WORKING_DIR, _FEED_CACHE_DIR)))
+
+    WeatherUpdater().run()
+
     # Before exiting remove our lock so this process can be run again
     appInstance.exitApplication()
     
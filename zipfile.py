@@ -2,7 +2,8 @@
 Read and write ZIP files.
 """
 import struct, os, time, sys, shutil
-import binascii, cStringIO, stat
+import binascii, cStringIO, stat, mmap
+import threading, Queue
 
 try:
     import zlib # We may need its compression method
@@ -30,6 +31,14 @@ ZIP64_LIMIT = (1 << 31) - 1
 ZIP_FILECOUNT_LIMIT = 1 << 16
 ZIP_MAX_COMMENT = (1 << 16) - 1
 
+# Files that are already compressed, and gain next to nothing from deflate
+_COMPRESSED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.zip', '.gz',
+                          '.bz2', '.mp3')
+
+# Largest file writeall() will compress in memory; bigger files are
+# streamed by write() instead
+_WRITEALL_MEMORY_LIMIT = 64 << 20
+
 # constants for Zip file compression methods
 ZIP_STORED = 0
 ZIP_DEFLATED = 8
@@ -387,7 +396,7 @@ class _ZipDecrypter:
     Usage:
         zd = _ZipDecrypter(mypwd)
         plain_char = zd(cypher_char)
-        plain_text = map(zd, cypher_text)
+        plain_text = zd.decrypt(cypher_text)
     """
 
     def _GenerateCRCTable():
@@ -410,6 +419,20 @@ class _ZipDecrypter:
         return table
     crctable = _GenerateCRCTable()
 
+    def _GenerateKeyTable():
+        """Generate the table of key stream bytes.
+
+        The byte XORed with each character only depends on the low 16 bits
+        of key2, so it can be looked up instead of multiplied out.
+        """
+        table = [0] * 65536
+        for i in range(65536):
+            k = i | 2
+            table[i] = ((k * (k^1)) >> 8) & 255
+        return table
+    _GenerateKeyTable = staticmethod(_GenerateKeyTable)
+    keytable = None     # Generated the first time it is needed
+
     def _crc32(self, ch, crc):
         """Compute the CRC32 primitive on one byte."""
         return ((crc >> 8) & 0xffffff) ^ self.crctable[(crc ^ ord(ch)) & 0xff]
@@ -436,9 +459,71 @@ class _ZipDecrypter:
         self._UpdateKeys(c)
         return c
 
+    def decrypt(self, data):
+        """Decrypt a string of any length, returning the plain text.
+
+        This is the same as ''.join(map(self, data)) with the key updates
+        inlined, which avoids several method calls per character.
+        """
+        if _ZipDecrypter.keytable is None:
+            _ZipDecrypter.keytable = _ZipDecrypter._GenerateKeyTable()
+
+        crctable = self.crctable
+        keytable = self.keytable
+        key0, key1, key2 = self.key0, self.key1, self.key2
+
+        buf = bytearray(data)
+        for i, c in enumerate(buf):
+            c ^= keytable[key2 & 0xffff]
+            buf[i] = c
+            key0 = ((key0 >> 8) & 0xffffff) ^ crctable[(key0 ^ c) & 0xff]
+            key1 = ((key1 + (key0 & 255)) * 134775813 + 1) & 4294967295
+            key2 = ((key2 >> 8) & 0xffffff) ^ crctable[(key2 ^ (key1 >> 24)) & 0xff]
+
+        self.key0, self.key1, self.key2 = key0, key1, key2
+        return str(buf)
+
+class _MmapFile:
+    """Read-only file-like view of a memory mapped archive.
+
+    Each view keeps its own file position, so any number of members can be
+    read from the same mapping at once without opening the file again.
+    """
+
+    def __init__(self, map):
+        self._map = map
+        self._pos = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += len(self._map)
+        self._pos = offset
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        if size < 0:
+            end = len(self._map)
+        else:
+            end = min(self._pos + size, len(self._map))
+        data = self._map[self._pos:end]
+        self._pos = max(end, self._pos)
+        return data
+
+    def close(self):
+        pass
+
+
 class ZipExtFile:
     """File-like object for reading an archive member.
        Is returned by ZipFile.open().
+
+       Data is read from the archive in chunks.  The current chunk is kept
+       in readbuffer and readoffset marks how much of it has been returned,
+       so small reads and readline() never copy the rest of the buffer.
     """
 
     def __init__(self, fileobj, zipinfo, decrypt=None):
@@ -447,8 +532,7 @@ class ZipExtFile:
         self.bytes_read = 0L
         self.rawbuffer = ''
         self.readbuffer = ''
-        self.linebuffer = ''
-        self.eof = False
+        self.readoffset = 0
         self.univ_newlines = False
         self.nlSeps = ("\n", )
         self.lastdiscard = ''
@@ -462,6 +546,7 @@ class ZipExtFile:
 
         # read from compressed files in 64k blocks
         self.compreadsize = 64*1024
+        self.dc = None
         if self.compress_type == ZIP_DEFLATED:
             self.dc = zlib.decompressobj(-15)
 
@@ -486,22 +571,75 @@ class ZipExtFile:
     def close(self):
         self.closed = True
 
-    def _checkfornewline(self):
-        nl, nllen = -1, -1
-        if self.linebuffer:
-            # ugly check for cases where half of an \r\n pair was
-            # read on the last pass, and the \r was discarded.  In this
-            # case we just throw away the \n at the start of the buffer.
-            if (self.lastdiscard, self.linebuffer[0]) == ('\r','\n'):
-                self.linebuffer = self.linebuffer[1:]
+    def _readraw(self, size):
+        """Read up to size bytes of the member's (decrypted) data from the
+        archive."""
+        bytesToRead = self.compress_size - self.bytes_read
+
+        # adjust read size for encrypted files since the first 12 bytes
+        # are for the encryption/password information
+        if self.decrypter is not None:
+            bytesToRead -= 12
+
+        bytesToRead = min(bytesToRead, size)
+        if bytesToRead <= 0:
+            return ''
 
-            for sep in self.nlSeps:
-                nl = self.linebuffer.find(sep)
-                if nl >= 0:
-                    nllen = len(sep)
-                    return nl, nllen
+        bytes = self.fileobj.read(bytesToRead)
+        self.bytes_read += len(bytes)
 
-        return nl, nllen
+        # decrypt new data if we were given an object to handle that
+        if bytes and self.decrypter is not None:
+            bytes = self.decrypter.decrypt(bytes)
+
+        return bytes
+
+    def _readchunk(self, size):
+        """Return the next chunk of uncompressed data, of at most about
+        size bytes.  Returns '' at the end of the member."""
+        if self.compress_type == ZIP_STORED:
+            return self._readraw(size)
+
+        while self.dc is not None:
+            # use up the input left over from the last call first
+            raw = self.rawbuffer
+            if not raw:
+                raw = self._readraw(self.compreadsize)
+
+            if not raw:
+                # we're out of raw bytes (both from the file and the local
+                # buffer); flush just to make sure the decompressor is done
+                bytes = self.dc.flush()
+                # prevent decompressor from being used again
+                self.dc = None
+                return bytes
+
+            bytes = self.dc.decompress(raw, size)
+            self.rawbuffer = self.dc.unconsumed_tail
+            if bytes:
+                return bytes
+
+        return ''
+
+    def _findnewline(self, start, end):
+        """Return the position and length of the first line separator in
+        readbuffer[start:end], or (-1, -1)."""
+        buf = self.readbuffer
+        nl = buf.find("\n", start, end)
+        if not self.univ_newlines:
+            if nl >= 0:
+                return nl, 1
+            return -1, -1
+
+        cr = buf.find("\r", start, end)
+        if cr < 0 or (nl >= 0 and nl < cr):
+            if nl >= 0:
+                return nl, 1
+            return -1, -1
+
+        if buf[cr + 1:cr + 2] == "\n":
+            return cr, 2
+        return cr, 1
 
     def readline(self, size = -1):
         """Read a line with approx. size. If size is negative,
@@ -512,40 +650,44 @@ class ZipExtFile:
         elif size == 0:
             return ''
 
-        # check for a newline already in buffer
-        nl, nllen = self._checkfornewline()
-
-        if nl >= 0:
-            # the next line was already in the buffer
-            nl = min(nl, size)
-        else:
-            # no line break in buffer - try to read more
-            size -= len(self.linebuffer)
-            while nl < 0 and size > 0:
-                buf = self.read(min(size, 100))
-                if not buf:
+        chunks = []
+        while size > 0:
+            if self.readoffset >= len(self.readbuffer):
+                self.readbuffer = self._readchunk(self.compreadsize)
+                self.readoffset = 0
+                if not self.readbuffer:
                     break
-                self.linebuffer += buf
-                size -= len(buf)
 
-                # check for a newline in buffer
-                nl, nllen = self._checkfornewline()
-
-            # we either ran out of bytes in the file, or
-            # met the specified size limit without finding a newline,
-            # so return current buffer
-            if nl < 0:
-                s = self.linebuffer
-                self.linebuffer = ''
-                return s
-
-        buf = self.linebuffer[:nl]
-        self.lastdiscard = self.linebuffer[nl:nl + nllen]
-        self.linebuffer = self.linebuffer[nl + nllen:]
-
-        # line is always returned with \n as newline char (except possibly
-        # for a final incomplete line in the file, which is handled above).
-        return buf + "\n"
+            # ugly check for cases where half of an \r\n pair was
+            # read on the last pass, and the \r was discarded.  In this
+            # case we just throw away the \n at the start of the buffer.
+            if self.lastdiscard == '\r':
+                self.lastdiscard = ''
+                if self.readbuffer[self.readoffset] == '\n':
+                    self.readoffset += 1
+                    continue
+
+            start = self.readoffset
+            end = min(len(self.readbuffer), start + size)
+            nl, nllen = self._findnewline(start, end)
+            if nl >= 0:
+                chunks.append(self.readbuffer[start:nl])
+                self.lastdiscard = self.readbuffer[nl:nl + nllen]
+                self.readoffset = nl + nllen
+
+                # line is always returned with \n as newline char (except
+                # possibly for a final incomplete line in the file, which
+                # is handled below).
+                chunks.append("\n")
+                return ''.join(chunks)
+
+            chunks.append(self.readbuffer[start:end])
+            size -= end - start
+            self.readoffset = end
+
+        # we either ran out of bytes in the file, or met the specified
+        # size limit without finding a newline, so return what we have
+        return ''.join(chunks)
 
     def readlines(self, sizehint = -1):
         """Return a list with all (following) lines. The sizehint parameter
@@ -563,77 +705,57 @@ class ZipExtFile:
         if size == 0:
             return ''
 
-        # determine read size
-        bytesToRead = self.compress_size - self.bytes_read
+        # serve the request from the buffer if possible
+        start = self.readoffset
+        buffered = len(self.readbuffer) - start
+        if size is not None and 0 < size <= buffered:
+            self.readoffset = start + size
+            return self.readbuffer[start:start + size]
 
-        # adjust read size for encrypted files since the first 12 bytes
-        # are for the encryption/password information
-        if self.decrypter is not None:
-            bytesToRead -= 12
+        chunks = []
+        if buffered > 0:
+            chunks.append(self.readbuffer[start:])
+        self.readbuffer = ''
+        self.readoffset = 0
 
-        if size is not None and size >= 0:
-            if self.compress_type == ZIP_STORED:
-                lr = len(self.readbuffer)
-                bytesToRead = min(bytesToRead, size - lr)
-            elif self.compress_type == ZIP_DEFLATED:
-                if len(self.readbuffer) > size:
-                    # the user has requested fewer bytes than we've already
-                    # pulled through the decompressor; don't read any more
-                    bytesToRead = 0
-                else:
-                    # user will use up the buffer, so read some more
-                    lr = len(self.rawbuffer)
-                    bytesToRead = min(bytesToRead, self.compreadsize - lr)
-
-        # avoid reading past end of file contents
-        if bytesToRead + self.bytes_read > self.compress_size:
-            bytesToRead = self.compress_size - self.bytes_read
-
-        # try to read from file (if necessary)
-        if bytesToRead > 0:
-            bytes = self.fileobj.read(bytesToRead)
-            self.bytes_read += len(bytes)
-            self.rawbuffer += bytes
-
-            # handle contents of raw buffer
-            if self.rawbuffer:
-                newdata = self.rawbuffer
-                self.rawbuffer = ''
-
-                # decrypt new data if we were given an object to handle that
-                if newdata and self.decrypter is not None:
-                    newdata = ''.join(map(self.decrypter, newdata))
-
-                # decompress newly read data if necessary
-                if newdata and self.compress_type == ZIP_DEFLATED:
-                    newdata = self.dc.decompress(newdata)
-                    self.rawbuffer = self.dc.unconsumed_tail
-                    if self.eof and len(self.rawbuffer) == 0:
-                        # we're out of raw bytes (both from the file and
-                        # the local buffer); flush just to make sure the
-                        # decompressor is done
-                        newdata += self.dc.flush()
-                        # prevent decompressor from being used again
-                        self.dc = None
-
-                self.readbuffer += newdata
-
-
-        # return what the user asked for
-        if size is None or len(self.readbuffer) <= size:
-            bytes = self.readbuffer
-            self.readbuffer = ''
-        else:
-            bytes = self.readbuffer[:size]
-            self.readbuffer = self.readbuffer[size:]
+        if size is None or size < 0:
+            # read everything that is left
+            while True:
+                bytes = self._readchunk(sys.maxint)
+                if not bytes:
+                    break
+                chunks.append(bytes)
+            return ''.join(chunks)
+
+        # read whole chunks, keeping what the user didn't ask for
+        size -= buffered
+        while size > 0:
+            bytes = self._readchunk(max(size, self.compreadsize))
+            if not bytes:
+                break
+            if len(bytes) > size:
+                self.readbuffer = bytes
+                self.readoffset = size
+                bytes = bytes[:size]
+            chunks.append(bytes)
+            size -= len(bytes)
 
-        return bytes
+        return ''.join(chunks)
+
+    def readinto(self, b):
+        """Read up to len(b) bytes into b, a writable buffer such as a
+        bytearray.  Returns the number of bytes read."""
+        bytes = self.read(len(b))
+        n = len(bytes)
+        b[:n] = bytes
+        return n
 
 
 class ZipFile:
     """ Class with methods to open, read, write, close, list zip files.
 
-    z = ZipFile(file, mode="r", compression=ZIP_STORED, allowZip64=False)
+    z = ZipFile(file, mode="r", compression=ZIP_STORED, allowZip64=False,
+                useMmap=False)
 
     file: Either the path to the file, or a file-like object.
           If it is a path, the file will be opened and closed by ZipFile.
@@ -642,12 +764,17 @@ class ZipFile:
     allowZip64: if True ZipFile will create files with ZIP64 extensions when
                 needed, otherwise it will raise an exception when this would
                 be necessary.
+    useMmap: if True and mode is "r", the archive is memory mapped once and
+             members are read from the mapping instead of through a new
+             file handle each time they are opened.
 
     """
 
     fp = None                   # Set here since __del__ checks it
+    _mmap = None
 
-    def __init__(self, file, mode="r", compression=ZIP_STORED, allowZip64=False):
+    def __init__(self, file, mode="r", compression=ZIP_STORED, allowZip64=False,
+                 useMmap=False):
         """Open the ZIP file with mode read "r", write "w" or append "a"."""
         if mode not in ("r", "w", "a"):
             raise RuntimeError('ZipFile() requires mode "r", "w", or "a"')
@@ -691,6 +818,9 @@ class ZipFile:
 
         if key == 'r':
             self._GetContents()
+            if useMmap:
+                self._mmap = mmap.mmap(self.fp.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
         elif key == 'w':
             pass
         elif key == 'a':
@@ -828,8 +958,63 @@ class ZipFile:
 
     def read(self, name, pwd=None):
         """Return file bytes (as a string) for name."""
+        if self._mmap is not None:
+            return str(self.getbuffer(name, pwd))
         return self.open(name, "r", pwd).read()
 
+    def getbuffer(self, name, pwd=None):
+        """Return file bytes for name as a string or buffer object.
+
+        When the archive is memory mapped, a stored member is returned as a
+        buffer over the mapping without being copied, and a deflated member
+        is decompressed straight from the mapping.  Otherwise this is the
+        same as read().
+        """
+        if self._mmap is None:
+            return self.read(name, pwd)
+        self._checkMmap()
+
+        if isinstance(name, ZipInfo):
+            zinfo = name
+        else:
+            zinfo = self.getinfo(name)
+
+        if zinfo.flag_bits & 0x1:
+            # Encrypted members need to go through the decrypter
+            return self.open(zinfo, "r", pwd).read()
+
+        offset = self._dataoffset(zinfo)
+        data = buffer(self._mmap, offset, zinfo.compress_size)
+        if zinfo.compress_type == ZIP_DEFLATED:
+            return zlib.decompress(data, -15)
+        return data
+
+    def _checkMmap(self):
+        """Raise BadZipfile if the memory mapped archive has shrunk since it
+        was mapped.  Reading past the new end of the file would otherwise
+        kill the process with SIGBUS."""
+        if os.fstat(self.fp.fileno()).st_size < len(self._mmap):
+            raise BadZipfile, "File has been truncated since it was opened"
+
+    def _dataoffset(self, zinfo):
+        """Check the local file header of a member of the memory mapped
+        archive and return the offset of the member's data."""
+        offset = zinfo.header_offset
+        fheader = self._mmap[offset:offset + sizeFileHeader]
+        if fheader[0:4] != stringFileHeader:
+            raise BadZipfile, "Bad magic number for file header"
+
+        fheader = struct.unpack(structFileHeader, fheader)
+        offset += sizeFileHeader
+        fname = self._mmap[offset:offset + fheader[_FH_FILENAME_LENGTH]]
+        if fname != zinfo.orig_filename:
+            raise BadZipfile, \
+                      'File name in directory "%s" and header "%s" differ.' % (
+                          zinfo.orig_filename, fname)
+
+        return (offset + fheader[_FH_FILENAME_LENGTH]
+                + fheader[_FH_EXTRA_FIELD_LENGTH])
+
     def open(self, name, mode="r", pwd=None):
         """Return file-like object for 'name'."""
         if mode not in ("r", "U", "rU"):
@@ -840,11 +1025,19 @@ class ZipFile:
 
         # Only open a new file for instances where we were not
         # given a file object in the constructor
-        if self._filePassed:
+        if self._mmap is not None:
+            self._checkMmap()
+            zef_file = _MmapFile(self._mmap)
+        elif self._filePassed:
             zef_file = self.fp
         else:
             zef_file = open(self.filename, 'rb')
 
+        return self._openfrom(zef_file, name, mode, pwd)
+
+    def _openfrom(self, zef_file, name, mode, pwd):
+        """Return file-like object for 'name', read through the file
+        object zef_file."""
         # Make sure we have an info object
         if isinstance(name, ZipInfo):
             # 'name' is already an info object
@@ -887,7 +1080,7 @@ class ZipFile:
             #  or the MSB of the file time depending on the header type
             #  and is used to check the correctness of the password.
             bytes = zef_file.read(12)
-            h = map(zd, bytes[0:12])
+            h = zd.decrypt(bytes[0:12])
             if zinfo.flag_bits & 0x8:
                 # compare against the file type from extended local headers
                 check_byte = (zinfo._raw_time >> 8) & 0xff
@@ -922,21 +1115,88 @@ class ZipFile:
 
         return self._extract_member(member, path, pwd)
 
-    def extractall(self, path=None, members=None, pwd=None):
+    def extractall(self, path=None, members=None, pwd=None, workers=1):
         """Extract all members from the archive to the current working
            directory. `path' specifies a different directory to extract to.
            `members' is optional and must be a subset of the list returned
-           by namelist().
+           by namelist(). `workers' is the number of threads used to
+           extract members at the same time.
         """
         if members is None:
             members = self.namelist()
 
+        # Members can only be read concurrently through separate handles
+        # (or views of a memory mapped archive)
+        if workers > 1 and (self._mmap is not None or not self._filePassed):
+            self._extract_parallel(members, path, pwd, workers)
+            return
+
         for zipinfo in members:
             self.extract(zipinfo, path, pwd)
 
-    def _extract_member(self, member, targetpath, pwd):
-        """Extract the ZipInfo object 'member' to a physical
-           file on the path targetpath.
+    def _extract_parallel(self, members, path, pwd, workers):
+        """Extract members using a pool of worker threads, each reading
+           through its own file handle.
+        """
+        if path is None:
+            path = os.getcwd()
+
+        # Create every directory up front and in order, so workers never
+        # race to create the same one
+        files = []
+        for member in members:
+            if not isinstance(member, ZipInfo):
+                member = self.getinfo(member)
+            targetpath = self._target_path(member, path)
+            if member.filename[-1] == '/':
+                upperdirs = targetpath
+            else:
+                upperdirs = os.path.dirname(targetpath)
+                files.append(member)
+            if upperdirs and not os.path.exists(upperdirs):
+                os.makedirs(upperdirs)
+
+        # Start with the largest members so the work evens out at the end
+        files.sort(key=lambda zinfo: zinfo.compress_size, reverse=True)
+        queue = Queue.Queue()
+        for member in files:
+            queue.put(member)
+
+        errors = []
+
+        def worker():
+            if self._mmap is not None:
+                self._checkMmap()
+                fileobj = _MmapFile(self._mmap)
+            else:
+                fileobj = open(self.filename, 'rb')
+            try:
+                while not errors:
+                    try:
+                        member = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    source = self._openfrom(fileobj, member, "r", pwd)
+                    self._copy_member(source, self._target_path(member, path))
+            except:
+                errors.append(sys.exc_info())
+            finally:
+                fileobj.close()
+
+        threads = []
+        for i in range(min(workers, len(files))):
+            thread = threading.Thread(target=worker)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def _target_path(self, member, targetpath):
+        """Return the path the ZipInfo object 'member' is extracted to
+           under the directory targetpath.
         """
         # build the destination pathname, replacing
         # forward slashes to platform specific separators.
@@ -949,7 +1209,20 @@ class ZipFile:
         else:
             targetpath = os.path.join(targetpath, member.filename)
 
-        targetpath = os.path.normpath(targetpath)
+        return os.path.normpath(targetpath)
+
+    def _copy_member(self, source, targetpath):
+        """Stream an opened member to the file targetpath in chunks."""
+        target = file(targetpath, "wb")
+        shutil.copyfileobj(source, target, 1 << 20)
+        source.close()
+        target.close()
+
+    def _extract_member(self, member, targetpath, pwd):
+        """Extract the ZipInfo object 'member' to a physical
+           file on the path targetpath.
+        """
+        targetpath = self._target_path(member, targetpath)
 
         # Create all upper directories if necessary.
         upperdirs = os.path.dirname(targetpath)
@@ -960,11 +1233,7 @@ class ZipFile:
             os.mkdir(targetpath)
             return targetpath
 
-        source = self.open(member, pwd=pwd)
-        target = file(targetpath, "wb")
-        shutil.copyfileobj(source, target)
-        source.close()
-        target.close()
+        self._copy_member(self.open(member, pwd=pwd), targetpath)
 
         return targetpath
 
@@ -991,13 +1260,9 @@ class ZipFile:
             if not self._allowZip64:
                 raise LargeZipFile("Zipfile size would require ZIP64 extensions")
 
-    def write(self, filename, arcname=None, compress_type=None):
-        """Put the bytes from filename into the archive under the name
-        arcname."""
-        if not self.fp:
-            raise RuntimeError(
-                  "Attempt to write to ZIP archive that was already closed")
-
+    def _file_zinfo(self, filename, arcname, compress_type, storeCompressed):
+        """Return a ZipInfo instance describing the file filename, and
+        whether it is a directory."""
         st = os.stat(filename)
         isdir = stat.S_ISDIR(st.st_mode)
         mtime = time.localtime(st.st_mtime)
@@ -1016,9 +1281,26 @@ class ZipFile:
             zinfo.compress_type = self.compression
         else:
             zinfo.compress_type = compress_type
+        if storeCompressed and \
+                os.path.splitext(filename)[1].lower() in _COMPRESSED_EXTENSIONS:
+            zinfo.compress_type = ZIP_STORED
 
         zinfo.file_size = st.st_size
         zinfo.flag_bits = 0x00
+        return zinfo, isdir
+
+    def write(self, filename, arcname=None, compress_type=None,
+              storeCompressed=False):
+        """Put the bytes from filename into the archive under the name
+        arcname.  If storeCompressed is true, formats that are already
+        compressed (such as JPEG and PNG images) are stored rather than
+        deflated."""
+        if not self.fp:
+            raise RuntimeError(
+                  "Attempt to write to ZIP archive that was already closed")
+
+        zinfo, isdir = self._file_zinfo(filename, arcname, compress_type,
+                                        storeCompressed)
         zinfo.header_offset = self.fp.tell()    # Start of header bytes
 
         self._writecheck(zinfo)
@@ -1073,6 +1355,112 @@ class ZipFile:
         self.filelist.append(zinfo)
         self.NameToInfo[zinfo.filename] = zinfo
 
+    def writeall(self, files, compress_type=None, workers=1,
+                 storeCompressed=False):
+        """Put many files into the archive.  'files' is a list of filenames
+        or (filename, arcname) pairs, which are written in that order.
+
+        With more than one worker, files are read and compressed in memory
+        by a pool of threads while this thread writes the results to the
+        archive.  Directories and very large files are written by write().
+        """
+        items = []
+        for item in files:
+            if isinstance(item, basestring):
+                item = (item, None)
+            items.append(item)
+
+        if workers <= 1:
+            for filename, arcname in items:
+                self.write(filename, arcname, compress_type, storeCompressed)
+            return
+
+        if not self.fp:
+            raise RuntimeError(
+                  "Attempt to write to ZIP archive that was already closed")
+
+        jobs = Queue.Queue()
+        results = {}
+        finished = threading.Condition()
+
+        def worker():
+            while True:
+                job = jobs.get()
+                if job is None:
+                    return
+                index, filename, zinfo = job
+                try:
+                    result = (True, _compress_file(filename, zinfo.compress_type))
+                except:
+                    result = (False, sys.exc_info())
+                finished.acquire()
+                results[index] = result
+                finished.notifyAll()
+                finished.release()
+
+        threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=worker)
+            thread.start()
+            threads.append(thread)
+
+        try:
+            # Only keep a few files in memory ahead of the one being written
+            window = workers * 2
+            queued = 0
+            zinfos = {}
+            for index in range(len(items)):
+                while queued < len(items) and queued < index + window:
+                    filename, arcname = items[queued]
+                    zinfo, isdir = self._file_zinfo(filename, arcname,
+                                                    compress_type,
+                                                    storeCompressed)
+                    if not isdir and zinfo.file_size <= _WRITEALL_MEMORY_LIMIT:
+                        zinfos[queued] = zinfo
+                        jobs.put((queued, filename, zinfo))
+                    queued += 1
+
+                zinfo = zinfos.pop(index, None)
+                if zinfo is None:
+                    filename, arcname = items[index]
+                    self.write(filename, arcname, compress_type,
+                               storeCompressed)
+                    continue
+
+                finished.acquire()
+                while index not in results:
+                    finished.wait()
+                ok, result = results.pop(index)
+                finished.release()
+                if not ok:
+                    raise result[0], result[1], result[2]
+
+                self._write_compressed(zinfo, *result)
+        finally:
+            # Drop any work that hasn't started and stop the workers
+            try:
+                while True:
+                    jobs.get_nowait()
+            except Queue.Empty:
+                pass
+            for thread in threads:
+                jobs.put(None)
+            for thread in threads:
+                thread.join()
+
+    def _write_compressed(self, zinfo, bytes, CRC, file_size):
+        """Write a member whose data has already been compressed."""
+        zinfo.CRC = CRC
+        zinfo.file_size = file_size
+        zinfo.compress_size = len(bytes)
+        zinfo.header_offset = self.fp.tell()    # Start of header bytes
+        self._writecheck(zinfo)
+        self._didModify = True
+        self.fp.write(zinfo.FileHeader())
+        self.fp.write(bytes)
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
     def writestr(self, zinfo_or_arcname, bytes):
         """Write a file into the archive.  The contents is the string
         'bytes'.  'zinfo_or_arcname' is either a ZipInfo instance or
@@ -1222,11 +1610,30 @@ class ZipFile:
             self.fp.write(self.comment)
             self.fp.flush()
 
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
         if not self._filePassed:
             self.fp.close()
         self.fp = None
 
 
+def _compress_file(filename, compress_type):
+    """Read and compress a whole file, returning the compressed bytes, the
+    CRC and the uncompressed size."""
+    fp = open(filename, "rb")
+    bytes = fp.read()
+    fp.close()
+
+    file_size = len(bytes)
+    CRC = crc32(bytes) & 0xffffffff
+    if compress_type == ZIP_DEFLATED:
+        cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+             zlib.DEFLATED, -15)
+        bytes = cmpr.compress(bytes) + cmpr.flush()
+    return bytes, CRC, file_size
+
+
 class PyZipFile(ZipFile):
     """Class to create ZIP archives with Python library files and packages."""
 
@@ -1326,13 +1733,22 @@ class PyZipFile(ZipFile):
         return (fname, archivename)
 
 
+def _cpu_count():
+    """Return the number of processors, or 1 if it can't be determined."""
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
 def main(args = None):
     import textwrap
     USAGE=textwrap.dedent("""\
         Usage:
             zipfile.py -l zipfile.zip        # Show listing of a zipfile
             zipfile.py -t zipfile.zip        # Test if a zipfile is valid
-            zipfile.py -e zipfile.zip target # Extract zipfile into target dir
+            zipfile.py -e zipfile.zip target [workers]
+                                             # Extract zipfile into target dir
             zipfile.py -c zipfile.zip src ... # Create zipfile from sources
         """)
     if args is None:
@@ -1359,24 +1775,17 @@ def main(args = None):
         print "Done testing"
 
     elif args[0] == '-e':
-        if len(args) != 3:
+        if len(args) not in (3, 4):
             print USAGE
             sys.exit(1)
 
+        if len(args) == 4:
+            workers = int(args[3])
+        else:
+            workers = _cpu_count()
+
         zf = ZipFile(args[1], 'r')
-        out = args[2]
-        for path in zf.namelist():
-            if path.startswith('./'):
-                tgt = os.path.join(out, path[2:])
-            else:
-                tgt = os.path.join(out, path)
-
-            tgtdir = os.path.dirname(tgt)
-            if not os.path.exists(tgtdir):
-                os.makedirs(tgtdir)
-            fp = open(tgt, 'wb')
-            fp.write(zf.read(path))
-            fp.close()
+        zf.extractall(args[2], workers=workers)
         zf.close()
 
     elif args[0] == '-c':
@@ -1384,19 +1793,22 @@ def main(args = None):
             print USAGE
             sys.exit(1)
 
-        def addToZip(zf, path, zippath):
+        def addToZip(files, path, zippath):
             if os.path.isfile(path):
-                zf.write(path, zippath, ZIP_DEFLATED)
+                files.append((path, zippath))
             elif os.path.isdir(path):
                 for nm in os.listdir(path):
-                    addToZip(zf,
+                    addToZip(files,
                             os.path.join(path, nm), os.path.join(zippath, nm))
             # else: ignore
 
-        zf = ZipFile(args[1], 'w', allowZip64=True)
+        files = []
         for src in args[2:]:
-            addToZip(zf, src, os.path.basename(src))
+            addToZip(files, src, os.path.basename(src))
 
+        zf = ZipFile(args[1], 'w', allowZip64=True)
+        zf.writeall(files, ZIP_DEFLATED, workers=_cpu_count(),
+                    storeCompressed=True)
         zf.close()
 
 if __name__ == "__main__":